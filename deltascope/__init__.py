@@ -9,24 +9,37 @@ import itertools as it
 import matplotlib as mpl
 import multiprocessing as mp
 from functools import partial
+from multiprocessing.pool import ThreadPool
 #import statsmodels.formula.api as smf
 #from mpl_toolkits.mplot3d import Axes3D
 import pandas as pd
 #import plotly.plotly as py
 #import plotly.graph_objs as go
 from scipy.optimize import minimize
-from sklearn.preprocessing import normalize,scale
+from sklearn.preprocessing import normalize,scale,StandardScaler
 import scipy
 from sklearn.decomposition import PCA
-from skimage.filters import median
+from skimage.filters import median,rank
+from skimage import img_as_ubyte
 from skimage.morphology import disk
 from sklearn.metrics import mean_squared_error
 from scipy.integrate import simps
 import scipy.stats as stats
 import re
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import StratifiedKFold
+from sklearn.inspection import permutation_importance
 import tqdm
 import glob
+import pickle
+import copy
+import hashlib
+from collections import OrderedDict
+from collections.abc import Mapping
+try:
+	import numba
+except ImportError:
+	numba = None
 
 class brain:
 	''' Object to manage biological data and associated functions. '''
@@ -47,12 +60,14 @@ class brain:
 		if size!=None:
 			self.df_align = self.df_align.sample(size)
 
-	def read_data(self,filepath):
+	def read_data(self,filepath,lazy=False,nsample=8):
 		'''
 		Reads 3D data from file and selects appropriate channel based on the
 		assumption that the channel with the most zeros has zero as the value for no signal
 
 		:param str filepath: Filepath to hdf5 probability file
+		:param bool lazy: (or None) If True, the channel is selected from a sample of z planes and :attr:`brain.raw_data` is a :py:class:`lazyChannel` (or a memory map for uncompressed files) that reads data from the file when it is indexed
+		:param int nsample: (or None) Number of z planes used to select the channel if `lazy` is True
 		:return: Creates the variable :attr:`brain.raw_data`
 
 		.. py:attribute:: brain.raw_data
@@ -60,6 +75,10 @@ class brain:
 			Array of shape [z,y,x] containing raw probability data
 		'''
 
+		if lazy == True:
+			self.raw_data = read_lazy_channel(filepath,nsample=nsample)
+			return
+
 		#Read h5 file and extract probability data
 		f = h5py.File(filepath,'r')
 
@@ -113,16 +132,45 @@ class brain:
 		df = pd.DataFrame({'x':flat[:,2]*scale[0],'y':flat[:,1]*scale[1],'z':flat[:,0]*scale[2],'value':flat[:,3]})
 		return(df)
 
-	def plot_projections(self,df,subset):
+	def select_points(self,data,mask,scale,dtype='float32'):
+		'''
+		Creates a pandas dataframe containing the x,y,z and signal/probability value for only the points in `data` that are selected by `mask`
+
+		Equivalent to filtering the output of :py:func:`brain.create_dataframe` with `mask`, including the index, without creating a dataframe of the full volume
+
+		:param array data: Raw probability data in 3D array
+		:param array mask: Boolean array with the same shape as `data` that is True for points that should be kept
+		:param array scale: Array of length three containing the micron values for [x,y,z]
+		:param str dtype: (or None) Data type of the x,y,z columns
+		:return: Pandas DataFrame with xyz and probability value for each selected point
+		'''
+
+		#Flat index of each selected point matches the index created by create_dataframe
+		flat = np.flatnonzero(mask)
+		z,y,x = np.unravel_index(flat,data.shape)
+
+		df = pd.DataFrame({'x':x.astype(dtype)*np.array(scale[0],dtype=dtype),
+			'y':y.astype(dtype)*np.array(scale[1],dtype=dtype),
+			'z':z.astype(dtype)*np.array(scale[2],dtype=dtype),
+			'value':np.asarray(data).ravel()[flat]},index=flat)
+		return(df)
+
+	def plot_projections(self,df,subset,npoints=None,density=False):
 		'''
 		Plots the x, y, and z projections of the input dataframe in a matplotlib plot
 
 		:param pd.DataFrame df: Dataframe with columns: 'x','y','z'
 		:param float subset: Value between 0 and 1 indicating what percentage of the df to subsample
+		:param int npoints: (or None) Plot a spatially stratified subsample of approximately `npoints` points selected by :py:func:`voxel_sample` instead of a random fraction
+		:param bool density: (or None) If True, plot each projection of all points as a 2D histogram image with :py:func:`hist_projection`
 		:returns: Matplotlib figure with three labeled scatterplots
 		'''
 
-		df = df.sample(frac=subset)
+		if density == False:
+			if npoints != None:
+				df = voxel_sample(df,npoints)
+			else:
+				df = df.sample(frac=subset)
 
     	#Create figure and subplots
 		fig = plt.figure(figsize=(12,6))
@@ -131,9 +179,14 @@ class brain:
 		az = fig.add_subplot(133)
 
 		#Create scatter plot for each projection
-		ax.scatter(df.x,df.z)
-		ay.scatter(df.x,df.y)
-		az.scatter(df.z,df.y)
+		if density == True:
+			hist_projection(ax,df.x,df.z)
+			hist_projection(ay,df.x,df.y)
+			hist_projection(az,df.z,df.y)
+		else:
+			ax.scatter(df.x,df.z)
+			ay.scatter(df.x,df.y)
+			az.scatter(df.z,df.y)
 
 		#Plot model
 		xvalues = np.arange(np.min(df.x),np.max(df.x))
@@ -155,7 +208,35 @@ class brain:
 
 		return(fig)
 
-	def preprocess_data(self,threshold,scale,microns):
+	def select_points_slabs(self,data,threshold,scale,slab=None,dtype='float32'):
+		'''
+		Creates the same dataframe as :py:func:`brain.select_points` with the mask `data < threshold`, but reads and thresholds `data` one slab of z planes at a time so that the full volume is never loaded
+
+		:param array data: Raw probability data in 3D array or :py:class:`lazyChannel`
+		:param float threshold: Value between 0 and 1 to use as a cutoff for minimum pixel value
+		:param array scale: Array of length three containing the micron values for [x,y,z]
+		:param int slab: (or None) Number of z planes read at a time. Defaults to the chunk size of a :py:class:`lazyChannel` or 16.
+		:param str dtype: (or None) Data type of the x,y,z columns
+		:return: Pandas DataFrame with xyz and probability value for each selected point
+		'''
+
+		if slab == None:
+			slab = getattr(data,'slab',16)
+
+		nz,ny,nx = data.shape
+		L = []
+		for z0 in range(0,nz,slab):
+			sdata = np.asarray(data[z0:z0+slab])
+			df = self.select_points(sdata,sdata < threshold,scale,dtype=dtype)
+
+			#Shift points and index to the position of the slab in the volume
+			df['z'] += np.array(z0*scale[2],dtype=dtype)
+			df.index += z0*ny*nx
+			L.append(df)
+
+		return(pd.concat(L))
+
+	def preprocess_data(self,threshold,scale,microns,dense=False,points=None):
 		'''
 		Thresholds and scales data prior to PCA
 
@@ -164,6 +245,8 @@ class brain:
 		:param float threshold: Value between 0 and 1 to use as a cutoff for minimum pixel value
 		:param array scale: Array with three values representing the constant by which to multiply x,y,z respectively
 		:param array microns: Array with three values representing the x,y,z micron dimensions of the voxel
+		:param bool dense: (or None) If True, the dataframe of every point, :py:attr:`brain.df`, is created with :py:func:`brain.create_dataframe` before thresholding. By default only points below the threshold are converted with :py:func:`brain.select_points`.
+		:param pd.DataFrame points: (or None) Points that have already been thresholded, e.g. by :py:func:`embryo.preprocess_channels`, which are used as :py:attr:`brain.df_thresh`
 
 		.. py:attribute:: brain.threshold
 
@@ -178,12 +261,19 @@ class brain:
 			Dataframe containing data from :py:attr:`brain.df_thresh` after a scaling value has been applied
 		'''
 
-		#: Dataframe with four columns: x,y,z,value with all points in :py:attr:`brain.raw_data`
-		self.df = self.create_dataframe(self.raw_data,microns)
-
 		#Create new dataframe with values above threshold
 		self.threshold = threshold
-		self.df_thresh = self.df[self.df.value < self.threshold]
+		if points is not None:
+			self.df_thresh = points
+		elif dense == True:
+			#: Dataframe with four columns: x,y,z,value with all points in :py:attr:`brain.raw_data`
+			self.df = self.create_dataframe(self.raw_data,microns)
+			self.df_thresh = self.df[self.df.value < self.threshold]
+		elif type(self.raw_data) == np.ndarray:
+			self.df_thresh = self.select_points(self.raw_data,self.raw_data < self.threshold,microns)
+		else:
+			#Data read lazily from file is thresholded one slab at a time
+			self.df_thresh = self.select_points_slabs(self.raw_data,self.threshold,microns)
 
 		#Scale xyz by value in scale array to force PCA axis selection
 		self.scale = scale
@@ -192,29 +282,100 @@ class brain:
 			'y':self.df_thresh.y * self.scale[1],
 			'z':self.df_thresh.z * self.scale[2]})
 
-	def process_alignment_data(self,data,threshold,radius,microns):
+	def median_plane(self,plane,radius,mode='exact',factor=2):
+		'''
+		Apply a median filter twice to a single z plane
+
+		:param array plane: 2D array of data
+		:param int radius: Integer that determines the radius of the circle used for the median filter
+		:param str mode: (or None) ``'exact'`` uses skimage.filters.median. ``'rank'`` uses the histogram based skimage.filters.rank.median, which is faster for large radii. Planes that are not uint8 are quantized to 255 levels between their minimum and maximum and the result is returned in the original range and dtype, so values differ from ``'exact'`` by at most one level. ``'downsample'`` applies the filter to the plane downsampled by `factor` with radius/`factor` and then repeats each pixel back to the original size.
+		:param int factor: (or None) Downsampling factor used by ``'downsample'``
+		:returns: Filtered plane
+		'''
+
+		plane = np.asarray(plane)
+
+		if mode == 'exact':
+			return(median(median(plane,disk(radius)),disk(radius)))
+		elif mode == 'rank':
+			if plane.dtype == np.uint8:
+				return(rank.median(rank.median(plane,disk(radius)),disk(radius)))
+
+			#Quantize to 0-254 so that no value becomes the 255 background marker used by process_alignment_data
+			lo,hi = np.min(plane),np.max(plane)
+			if hi == lo:
+				return(plane.copy())
+			q = np.round((plane-lo)*(254/(hi-lo))).astype(np.uint8)
+			q = rank.median(rank.median(q,disk(radius)),disk(radius))
+			return((q*((hi-lo)/254)+lo).astype(plane.dtype))
+		elif mode == 'downsample':
+			r = max(1,int(round(radius/factor)))
+			small = median(median(plane[::factor,::factor],disk(r)),disk(r))
+			big = np.repeat(np.repeat(small,factor,axis=0),factor,axis=1)
+			return(big[:plane.shape[0],:plane.shape[1]])
+		else:
+			raise ValueError('Unknown median filter mode: '+str(mode))
+
+	def process_alignment_data(self,data,threshold,radius,microns,workers=None,mode='exact',factor=2):
 		'''
 		Applies a median filter twice to the data which is used for alignment
 
-		Ensures than any noise in the structural data does not interfere with alignment
+		Ensures than any noise in the structural data does not interfere with alignment. Z planes are filtered in parallel by a pool of threads.
 
 		:param array data: Raw data imported by the function :py:func:`brain.read_data`
 		:param float threshold: Value between 0 and 1 to use as a cutoff for minimum pixel value
 		:param int radius: Integer that determines the radius of the circle used for the median filter
 		:param array microns: Array with three values representing the x,y,z micron dimensions of the voxel
+		:param int workers: (or None) Number of threads used to filter planes. Defaults to the number of cpus, or 1 inside a worker process of a multiprocessing pool. 1 runs serially.
+		:param str mode: (or None) Filter used for each plane, see :py:func:`brain.median_plane`
+		:param int factor: (or None) Downsampling factor used if `mode` is ``'downsample'``
 		:returns: Dataframe containing data processed with the median filter and threshold
+
+		.. py:attribute:: brain.median_time
+
+			Array containing the number of seconds spent filtering each z plane
 		'''
 
-		#Iterate over each plane and apply median filter twice
-		self.out = np.zeros(data.shape)
-		for z in range(data.shape[0]):
-			self.out[z] = median(median(data[z],disk(radius)),disk(radius))
+		tic = time.time()
+
+		def filter_plane(z):
+			ptic = time.time()
+			#Planes are read one at a time so data can be a lazyChannel
+			plane = self.median_plane(data[z],radius,mode=mode,factor=factor)
+			return(z,plane,time.time()-ptic)
+
+		if workers == None:
+			#Worker processes of a pool, e.g. in mpTransformation, already use every cpu
+			if mp.current_process().daemon:
+				workers = 1
+			else:
+				workers = mp.cpu_count()
+
+		self.out = None
+		self.median_time = np.zeros(data.shape[0])
+
+		if workers == 1:
+			results = map(filter_plane,range(data.shape[0]))
+		else:
+			pool = ThreadPool(workers)
+			results = pool.imap_unordered(filter_plane,range(data.shape[0]))
+
+		for z,plane,dt in results:
+			if self.out is None:
+				self.out = np.zeros(data.shape,dtype=plane.dtype)
+			self.out[z] = plane
+			self.median_time[z] = dt
+
+		if workers != 1:
+			pool.close()
+			pool.join()
 
-		outdf = self.create_dataframe(self.out,microns)
-		thresh = outdf[outdf.value != 255]
+		print('Median filter complete',time.time()-tic,'s, mean per plane',np.mean(self.median_time),'s')
+
+		thresh = self.select_points(self.out,self.out != 255,microns)
 		return(thresh)
 
-	def calculate_pca_median(self,data,threshold,radius,microns):
+	def calculate_pca_median(self,data,threshold,radius,microns,workers=None,mode='exact',pyramid=None,sample=None,check=False):
 		'''
 		Calculate PCA transformation matrix, :py:attr:`brain.pcamed`, based on data (:py:attr:`brain.pcamed`) after applying median filter and threshold
 
@@ -222,6 +383,11 @@ class brain:
 		:param float threshold: Value between 0 and 1 indicating the lower cutoff for positive signal
 		:param int radius: Radius of neighborhood that should be considered for the median filter
 		:param array microns: Array with three values representing the x,y,z micron dimensions of the voxel
+		:param int workers: (or None) Number of threads used by :py:func:`brain.process_alignment_data`
+		:param str mode: (or None) Median filter mode, see :py:func:`brain.median_plane`
+		:param int pyramid: (or None) Factor by which the volume is downsampled before median filtering, see :py:func:`brain.fit_pca_median`
+		:param int sample: (or None) Number of median filtered points used to fit PCA
+		:param bool check: (or None) If True, also fit PCA at full resolution and save the angle between axes in :py:attr:`brain.pca_deviation`
 
 		.. py:attribute:: brain.median
 
@@ -233,12 +399,10 @@ class brain:
 
 		'''
 
-		self.median = self.process_alignment_data(data,threshold,radius,microns)
-
-		self.pcamed = PCA()
-		self.pcamed.fit(self.median[['x','y','z']])
+		self.fit_pca_median(['x','y','z'],data,threshold,radius,microns,workers=workers,mode=mode,
+			pyramid=pyramid,sample=sample,check=check)
 
-	def calculate_pca_median_2d(self,data,threshold,radius,microns):
+	def calculate_pca_median_2d(self,data,threshold,radius,microns,workers=None,mode='exact',pyramid=None,sample=None,check=False):
 		'''
 		Calculate PCA transformation matrix for 2 dimensions of data, :py:attr:`brain.pcamed`, based on data after applying median filter and threshold
 
@@ -248,12 +412,120 @@ class brain:
 		:param float threshold: Value between 0 and 1 indicating the lower cutoff for positive signal
 		:param int radius: Radius of neighborhood that should be considered for the median filter
 		:param array microns: Array with three values representing the x,y,z micron dimensions of the voxel
+		:param int workers: (or None) Number of threads used by :py:func:`brain.process_alignment_data`
+		:param str mode: (or None) Median filter mode, see :py:func:`brain.median_plane`
+		:param int pyramid: (or None) Factor by which the volume is downsampled before median filtering, see :py:func:`brain.fit_pca_median`
+		:param int sample: (or None) Number of median filtered points used to fit PCA
+		:param bool check: (or None) If True, also fit PCA at full resolution and save the angle between axes in :py:attr:`brain.pca_deviation`
+		'''
+
+		self.fit_pca_median(['y','z'],data,threshold,radius,microns,workers=workers,mode=mode,
+			pyramid=pyramid,sample=sample,check=check)
+
+	def preprocess_data_cached(self,filepath,threshold,scale,microns,cache=None):
+		'''
+		Read and threshold data with :py:func:`brain.read_data` and :py:func:`brain.preprocess_data`, reusing :py:attr:`brain.df_thresh` from a :py:class:`stageCache` if the same file has already been processed with the same parameters
+
+		If the result is found in the cache, :py:attr:`brain.raw_data` is read lazily, see :py:func:`read_lazy_channel`. :py:attr:`brain.threshold`, :py:attr:`brain.scale` and :py:attr:`brain.df_scl` are set in the same way whether or not the result was cached.
+
+		:param str filepath: Filepath to hdf5 probability file
+		:param float threshold: Value between 0 and 1 to use as a cutoff for minimum pixel value
+		:param array scale: Array with three values representing the constant by which to multiply x,y,z respectively
+		:param array microns: Array with three values representing the x,y,z micron dimensions of the voxel
+		:param cache: (:py:class:`stageCache` or None) Cache to use, by default :py:data:`stage_cache`
+		'''
+
+		if cache == None:
+			cache = stage_cache
+
+		key = cache.make_key(filepath,'df_thresh',{'threshold':threshold,'scale':list(scale),'microns':list(microns)})
+		entry = cache.get(key)
+
+		if entry != None:
+			self.raw_data = read_lazy_channel(filepath)
+			#Set threshold, scale and df_scl as on a miss from the cached points
+			self.preprocess_data(threshold,scale,microns,points=entry[0]['df_thresh'])
+		else:
+			self.read_data(filepath)
+			self.preprocess_data(threshold,scale,microns)
+			cache.put(key,{'df_thresh':self.df_thresh})
+
+	def calculate_pca_median_cached(self,filepath,threshold,radius,microns,twoD=False,cache=None,**kwargs):
+		'''
+		Calculate :py:attr:`brain.pcamed` and :py:attr:`brain.median` with :py:func:`brain.calculate_pca_median` or :py:func:`brain.calculate_pca_median_2d`, reusing the results from a :py:class:`stageCache` if the same file has already been processed with the same parameters
+
+		:py:attr:`brain.raw_data` must be defined from `filepath` if the result is not in the cache
+
+		:param str filepath: Filepath to the hdf5 probability file that was read into :py:attr:`brain.raw_data`
+		:param float threshold: Value between 0 and 1 indicating the lower cutoff for positive signal
+		:param int radius: Radius of neighborhood that should be considered for the median filter
+		:param array microns: Array with three values representing the x,y,z micron dimensions of the voxel
+		:param bool twoD: (or None) If True, use :py:func:`brain.calculate_pca_median_2d`
+		:param cache: (:py:class:`stageCache` or None) Cache to use, by default :py:data:`stage_cache`
+		:param kwargs: Additional parameters passed to :py:func:`brain.fit_pca_median`, e.g. `pyramid`
+		'''
+
+		if cache == None:
+			cache = stage_cache
+
+		params = {'threshold':threshold,'radius':radius,'microns':list(microns),'twoD':twoD}
+		params.update(kwargs)
+		key = cache.make_key(filepath,'pca',params)
+		entry = cache.get(key)
+
+		if entry != None:
+			self.median = entry[0]['median']
+			self.pcamed = entry[1]['pcamed']
+		else:
+			if twoD == True:
+				self.calculate_pca_median_2d(self.raw_data,threshold,radius,microns,**kwargs)
+			else:
+				self.calculate_pca_median(self.raw_data,threshold,radius,microns,**kwargs)
+			cache.put(key,{'median':self.median},{'pcamed':self.pcamed})
+
+	def fit_pca_median(self,columns,data,threshold,radius,microns,workers=None,mode='exact',pyramid=None,sample=None,check=False):
+		'''
+		Median filter and threshold `data` with :py:func:`brain.process_alignment_data` and fit :py:attr:`brain.pcamed` to `columns`
+
+		Only three axes are needed for alignment, so the fit can be calculated from a reduced dataset. With `pyramid`, every `pyramid` th plane, row and column is kept, the radius of the filter is divided by `pyramid` and microns are multiplied by `pyramid` so that points remain in the same coordinate space. With `sample`, PCA is fit to a sample of points stratified by z plane.
+
+		:param list columns: Columns of :py:attr:`brain.median` used to fit PCA
+		:param array data: 3D array containing raw probability data
+		:param float threshold: Value between 0 and 1 indicating the lower cutoff for positive signal
+		:param int radius: Radius of neighborhood that should be considered for the median filter
+		:param array microns: Array with three values representing the x,y,z micron dimensions of the voxel
+		:param int workers: (or None) Number of threads used by :py:func:`brain.process_alignment_data`
+		:param str mode: (or None) Median filter mode, see :py:func:`brain.median_plane`
+		:param int pyramid: (or None) Downsampling factor, e.g. 2 or 4
+		:param int sample: (or None) Number of median filtered points used to fit PCA
+		:param bool check: (or None) If True, also fit PCA at full resolution and save the angle between axes in :py:attr:`brain.pca_deviation`
+
+		.. py:attribute:: brain.pca_deviation
+
+			Array containing the angle in degrees between each component of :py:attr:`brain.pcamed` and the component calculated at full resolution
 		'''
 
-		self.median = self.process_alignment_data(data,threshold,radius,microns)
+		if (pyramid != None) and (pyramid > 1):
+			small = downsample_volume(data,pyramid)
+			self.median = self.process_alignment_data(small,threshold,max(1,int(round(radius/pyramid))),
+				[m*pyramid for m in microns],workers=workers,mode=mode)
+		else:
+			self.median = self.process_alignment_data(data,threshold,radius,microns,workers=workers,mode=mode)
+
+		fitdf = self.median
+		if (sample != None) and (sample < len(self.median)):
+			fitdf = stratified_sample(self.median,sample)
 
 		self.pcamed = PCA()
-		self.pcamed.fit(self.median[['y','z']])
+		self.pcamed.fit(fitdf[columns])
+
+		if (check == True) and (fitdf is not self.median or ((pyramid != None) and (pyramid > 1))):
+			full = self.process_alignment_data(data,threshold,radius,microns,workers=workers,mode=mode)
+			ref = PCA()
+			ref.fit(full[columns])
+
+			self.pca_deviation = pca_angles(self.pcamed,ref)
+			print('Angular deviation from full resolution axes (degrees):',self.pca_deviation)
 
 	def pca_transform_2d(self,df,pca,comp_order,fit_dim,deg=2,mm=None,vertex=None,flip=None):
 		'''
@@ -567,15 +839,140 @@ class brain:
 		return(pd.Series({'x':row.x,'y':row.y,'z':row.z,'xc':xc, 'yc':yc, 'zc':zc,
 					'r':r, 'ac':ac, 'theta':theta}))
 
-	def transform_coordinates(self):
+	def find_min_distance_vectorized(self,x,z):
+		'''
+		Find the point on the model closest to every data point at once using :py:func:`closest_x`
+
+		:param np.array x: Array of x values of the data points
+		:param np.array z: Array of z values of the data points
+		:returns: Array of x positions on the curve closest to each data point
+		:rtype: np.array
+		'''
+
+		return(closest_x(x,z,self.mm.cf))
+
+	def refine_min_distance(self,xc,x,z,n=1):
+		'''
+		Improve estimates of the closest point on the model with Newton steps using :py:func:`refine_closest_x`
+
+		:param np.array xc: Array of estimated x positions on the curve
+		:param np.array x: Array of x values of the data points
+		:param np.array z: Array of z values of the data points
+		:param int n: Number of Newton steps to take
+		:returns: Array of refined x positions on the curve
+		:rtype: np.array
+		'''
+
+		return(refine_closest_x(xc,x,z,self.mm.cf,n=n))
+
+	def find_arclength_vectorized(self,xc):
+		'''
+		Calculate arclength between the vertex and each position in `xc` using :py:func:`model_arclength`
+
+		:param np.array xc: Array of positions in the x axis along the curve
+		:returns: Array of arclengths with the same sign convention as :py:func:`brain.find_arclength`
+		:rtype: np.array
+		'''
+
+		return(model_arclength(xc,self.mm.cf))
+
+	def calc_coord_vectorized(self,df,xc=None):
+		'''
+		Calculate alpha, r, theta for every row of `df` at once, equivalent to :py:func:`brain.calc_coord` applied to each row
+
+		:param pd.DataFrame df: Dataframe containing x,y,z
+		:param np.array xc: (or None) Array of x positions on the curve closest to each row if they have already been calculated
+		:returns: pd.DataFrame with the same columns as the output of :py:func:`brain.calc_coord`
+		'''
+
+		x,y,z = df.x.values,df.y.values,df.z.values
+
+		if type(xc) == type(None):
+			xc,r,ac = nearest_point_kernel(x,y,z,self.mm.cf)
+			zc = self.mm.p(xc)
+		else:
+			zc = self.mm.p(xc)
+			ac = self.find_arclength_vectorized(xc)
+			r = np.sqrt((z-zc)**2 + y**2 + (x-xc)**2)
+		yc = np.zeros(xc.shape)
+		theta = np.arctan2(y-yc,z-zc)
+
+		return(pd.DataFrame({'x':x,'y':y,'z':z,'xc':xc,'yc':yc,'zc':zc,
+					'r':r,'ac':ac,'theta':theta},index=df.index))
+
+	def transform_coordinates(self,method='minimize'):
 		'''
 		Transform coordinate system so that each point is defined relative to math model by (alpha,theta,r) (only applied to :py:attr:`brain.df_align`)
 
-		:returns: appends columns r, xc, yc, zc, ac, theta to :py:attr:`brain.df_align`
+		:param str method: (or None) ``'minimize'`` (default) calculates each row separately with :py:func:`brain.calc_coord`. ``'vectorized'`` calculates all rows at once with :py:func:`brain.calc_coord_vectorized` using :py:func:`nearest_point_kernel`.
+		:returns: appends columns r, xc, yc, zc, ac, theta to :py:attr:`brain.df_align` and resets its index to 0..n-1 with either method
+		'''
+
+		if method == 'minimize':
+			#Calculate alpha, theta, r for each row in dataset
+			self.df_align = self.df_align.merge(self.df_align.apply((lambda row: self.calc_coord(row)), axis=1))
+		elif method == 'vectorized':
+			#Reset the index in the same way as the merge used by 'minimize'
+			self.df_align = self.calc_coord_vectorized(self.df_align).reset_index(drop=True)
+		else:
+			raise ValueError('Unknown transformation method: '+str(method))
+
+	def transform_coordinates_chunked(self,chunksize=500000,filepath=None,dtype='float64'):
+		'''
+		Transform :py:attr:`brain.df_align` in fixed size chunks using the vectorized calculation so that memory use depends on `chunksize` instead of the number of points
+
+		Only ac, r and theta are kept for each chunk. Progress and throughput are printed after each chunk.
+
+		:param int chunksize: Number of points to transform at a time
+		:param str filepath: (or None) If a path is given, each chunk is written directly to a psi file in the format of :py:func:`write_data` and :py:attr:`brain.df_align` is left unchanged
+		:param str dtype: (or None) Data type of the ac, r and theta arrays added to :py:attr:`brain.df_align`
+		:returns: appends columns ac, r, theta to :py:attr:`brain.df_align` and resets its index to 0..n-1 if `filepath` is None, as in :py:func:`brain.transform_coordinates`
 		'''
 
-		#Calculate alpha, theta, r for each row in dataset
-		self.df_align = self.df_align.merge(self.df_align.apply((lambda row: self.calc_coord(row)), axis=1))
+		n = len(self.df_align)
+		nchunks = int(np.ceil(n/chunksize))
+		x,y,z = self.df_align.x.values,self.df_align.y.values,self.df_align.z.values
+
+		if filepath == None:
+			out = {'ac':np.empty(n,dtype=dtype),'r':np.empty(n,dtype=dtype),'theta':np.empty(n,dtype=dtype)}
+		else:
+			f = open(filepath,'w')
+			write_header(f)
+			f.write('\n'+str(n)+' 0 0\n')
+			f.write('1 0 0\n'+
+					'0 1 0\n'+
+					'0 0 1\n\n')
+
+		tic = time.time()
+		for i in range(nchunks):
+			ctic = time.time()
+			sl = slice(i*chunksize,min((i+1)*chunksize,n))
+			cx,cy,cz = x[sl],y[sl],z[sl]
+
+			xc,r,ac = nearest_point_kernel(cx,cy,cz,self.mm.cf)
+			theta = np.arctan2(cy,cz-self.mm.p(xc))
+
+			if filepath == None:
+				out['ac'][sl] = ac
+				out['r'][sl] = r
+				out['theta'][sl] = theta
+			else:
+				f.write(pd.DataFrame({'x':cx,'y':cy,'z':cz,'ac':ac,'theta':theta,'r':r},
+					index=np.arange(sl.start,sl.stop)).to_csv(sep=' ', index=True, header=False))
+
+			dt = time.time()-ctic
+			print('Chunk',i+1,'of',nchunks,'complete:',sl.stop,'of',n,'points,',
+				int((sl.stop-sl.start)/max(dt,1e-9)),'points/s')
+
+		if filepath == None:
+			self.df_align = self.df_align.reset_index(drop=True)
+			for k in ['ac','r','theta']:
+				self.df_align[k] = out[k]
+		else:
+			f.close()
+			print('Write to',filepath,'complete')
+
+		print('Transformation complete',n,'points in',time.time()-tic,'s')
 
 	def subset_data(self,df,sample_frac=0.5):
 		'''
@@ -649,20 +1046,39 @@ class embryo:
 		self.name = name
 		self.number = number
 
-	def add_channel(self,filepath,key):
+	def add_channel(self,filepath,key,lazy=False):
 		'''
 		Add channel to :py:attr:`embryo.chnls` dictionary
 
 		:param str filepath: Complete filepath to image
 		:param str key: Name of the channel
+		:param bool lazy: (or None) If True, data is read from the file when it is needed, see :py:func:`brain.read_data`
 		'''
 
 		s = brain()
-		s.read_data(filepath)
+		s.read_data(filepath,lazy=lazy)
 
 		self.chnls[key] = s
 
-	def process_channels(self,mthresh,gthresh,radius,scale,microns,deg,primary_key,comp_order,fit_dim):
+	def preprocess_channels(self,threshold,scale,microns,keys=None,slab=None):
+		'''
+		Threshold all channels together with :py:func:`select_points_channels` and pass the points of each channel to :py:func:`brain.preprocess_data`
+
+		:param float threshold: Value between 0 and 1 to use as a cutoff for minimum pixel value
+		:param array scale: Array with three values representing the constant by which to multiply x,y,z respectively
+		:param array microns: Array with three values representing the x,y,z micron dimensions of the voxel
+		:param list keys: (or None) Channels to process, by default all channels in :py:attr:`embryo.chnls`
+		:param int slab: (or None) Number of z planes read at a time
+		'''
+
+		if keys == None:
+			keys = list(self.chnls.keys())
+
+		D = select_points_channels({k:self.chnls[k].raw_data for k in keys},threshold,microns,slab=slab)
+		for k in keys:
+			self.chnls[k].preprocess_data(threshold,scale,microns,points=D[k])
+
+	def process_channels(self,mthresh,gthresh,radius,scale,microns,deg,primary_key,comp_order,fit_dim,pyramid=None):
 		'''
 		Process all channels through the production of the :py:attr:`brain.df_align` dataframe
 
@@ -675,13 +1091,15 @@ class embryo:
 		:param str primary_key: Key for the primary structural channel which PCA and the model should be fit too
 		:param array comp_order: Array specifies the assignment of components to x,y,z. Form [x component index, y component index, z component index], e.g. [0,2,1]
 		:param array fit_dim: Array of length two containing two strings describing the first and second axis for fitting the model, e.g. ['x','z']
+		:param int pyramid: (or None) Downsampling factor used to fit PCA, see :py:func:`brain.fit_pca_median`
 		'''
 
-		#Process primary channel
-		self.chnls[primary_key].preprocess_data(gthresh,scale,microns)
+		#Threshold all channels in a single pass
+		self.preprocess_channels(gthresh,scale,microns)
 
+		#Process primary channel
 		self.chnls[primary_key].calculate_pca_median(self.chnls[primary_key].raw_data,
-			mthresh,radius,microns)
+			mthresh,radius,microns,pyramid=pyramid)
 		self.pca = self.chnls[primary_key].pcamed
 
 		self.chnls[primary_key].align_data(self.chnls[primary_key].df_thresh,
@@ -695,8 +1113,6 @@ class embryo:
 
 		for ch in self.chnls.keys():
 			if ch != primary_key:
-				self.chnls[ch].preprocess_data(gthresh,scale,microns)
-
 				self.chnls[ch].align_data(self.chnls[ch].df_thresh,
 					self.pca,comp_order,fit_dim,deg=deg,
 					mm = self.mm, vertex = self.vertex)
@@ -704,31 +1120,40 @@ class embryo:
 				self.chnls[ch].transform_coordinates()
 				print(ch,'processed')
 
-	def save_projections(self,subset):
+	def save_projections(self,subset,npoints=None,density=False):
 		'''
 		Save projections of both channels into png files in :py:attr:`embryo.outdir` following the naming scheme [:py:attr:`embryo.name`]_[:py:attr:`embryo.number`]_[`channel name`]_MIP.png
 
 		:param float subset: Value between 0 and 1 to specify the fraction of the data to randomly sample for plotting
+		:param int npoints: (or None) Approximate number of points to plot from a spatially stratified subsample, see :py:func:`brain.plot_projections`
+		:param bool density: (or None) If True, plot projections as 2D histogram images
 		'''
 
 		for ch in self.chnls.keys():
-			fig = self.chnls[ch].plot_projections(self.chnls[ch].df_align,subset)
+			fig = self.chnls[ch].plot_projections(self.chnls[ch].df_align,subset,npoints=npoints,density=density)
 			fig.savefig(os.path.join(self.outdir,
 				self.name+'_'+self.number+'_'+ch+'_MIP.png'))
 
 		print('Projections generated')
 
-	def save_psi(self):
+	def save_psi(self,binary=False):
 		'''
 		Save all channels into psi files following the naming scheme [:py:attr:`embryo.name`]_[:py:attr:`embryo.number`]_[`channel name`].psi
+
+		:param bool binary: (or None) If True, channels are saved with :py:func:`write_data_hdf5` as .hdf5 files instead of psi files
 		'''
 
 		columns = ['x','y','z','ac','r','theta']
 
 		for ch in self.chnls.keys():
-			write_data(os.path.join(self.outdir,
-				self.name+'_'+str(self.number)+'_'+ch+'.psi'),
-				self.chnls[ch].df_align[columns])
+			if binary == True:
+				write_data_hdf5(os.path.join(self.outdir,
+					self.name+'_'+str(self.number)+'_'+ch+'.hdf5'),
+					self.chnls[ch].df_align[columns])
+			else:
+				write_data(os.path.join(self.outdir,
+					self.name+'_'+str(self.number)+'_'+ch+'.psi'),
+					self.chnls[ch].df_align[columns])
 
 		print('PSIs generated')
 
@@ -742,191 +1167,846 @@ class embryo:
 
 		self.chnls[key] = read_psi(filepath)
 
-class math_model:
+def select_points_channels(Ddata,threshold,scale,slab=None,dtype='float32'):
 	'''
-	Object to contain attributes associated with the math model of a sample
+	Threshold several channels of the same sample in one pass and return the same dataframe for each channel as :py:func:`brain.select_points` with the mask `data < threshold`
 
-	:param array model: Array of coefficients calculated by np.polyfit
+	Channels are read one slab of z planes at a time. The thresholded masks of all channels are written into one boolean array so that a single np.flatnonzero call selects the points of every channel, and the x,y,z coordinates are looked up in a grid that is calculated once for all channels.
 
-	.. py:attribute:: math_model.cf
+	:param dict Ddata: Dictionary of 3D arrays or :py:class:`lazyChannel` objects with the same shape
+	:param float threshold: Value between 0 and 1 to use as a cutoff for minimum pixel value
+	:param array scale: Array of length three containing the micron values for [x,y,z]
+	:param int slab: (or None) Number of z planes read at a time. Defaults to the chunk size of the first :py:class:`lazyChannel` or the whole volume for arrays
+	:param str dtype: (or None) Data type of the x,y,z columns
+	:returns: Dictionary of pd.DataFrame with the same keys as `Ddata`
+	'''
 
-		Array of coefficients for the math model
+	keys = list(Ddata.keys())
+	shape = Ddata[keys[0]].shape
+	for k in keys:
+		if Ddata[k].shape != shape:
+			raise ValueError('Channel '+str(k)+' has shape '+str(Ddata[k].shape)+' instead of '+str(shape))
+	nz,ny,nx = shape
 
-	.. py:attribute:: math_model.p
+	if slab == None:
+		if all([type(Ddata[k]) == np.ndarray for k in keys]):
+			slab = nz
+		else:
+			slab = getattr(Ddata[keys[0]],'slab',16)
 
-		Poly1d function for the math model to allow calculation and plotting of the model
-	'''
+	#Coordinate grid shared by all channels
+	grid = [np.arange(n).astype(dtype)*np.array(sc,dtype=dtype) for n,sc in zip([nx,ny,nz],scale)]
 
-	def __init__(self,model):
+	L = {k:[] for k in keys}
+	for z0 in range(0,nz,slab):
+		Lslab = [np.asarray(Ddata[k][z0:z0+slab]) for k in keys]
+		n = Lslab[0].size
 
-		self.cf = model
-		self.p = np.poly1d(model)
+		mask = np.empty((len(keys),)+Lslab[0].shape,dtype=bool)
+		for i,sdata in enumerate(Lslab):
+			np.less(sdata,threshold,out=mask[i])
+		flat = np.flatnonzero(mask)
 
-####### Alignment correction functions#########
+		#Flat indices are ordered by channel
+		bounds = np.searchsorted(flat,np.arange(len(keys)+1)*n)
+		for i,k in enumerate(keys):
+			fi = flat[bounds[i]:bounds[i+1]] - i*n
+			zi,yi,xi = np.unravel_index(fi,Lslab[i].shape)
+			L[k].append(pd.DataFrame({'x':grid[0][xi],'y':grid[1][yi],'z':grid[2][zi+z0],
+				'value':Lslab[i].ravel()[fi]},index=fi+z0*ny*nx))
 
-def find_anchors(df,dim):
-	''':param str dim: either y or z'''
-	mm = math_model(np.polyfit(df['x'],df[dim],2))
+	return({k:pd.concat(L[k]) for k in keys})
 
-	pt1 = {}
-	if mm.cf[0] > 0:
-		pt1[dim] = np.max(df[dim])
-	else:
-		pt1[dim] = np.min(df[dim])
-	pt1['x'] = df[df[dim] == pt1[dim]].x.values[0]
+def downsample_volume(data,factor):
+	'''
+	Keep every `factor` th plane, row and column of a 3D volume, reading one plane at a time
 
-	pt2 = {}
-	if abs(pt1['x']-np.min(df.x)) > abs(pt1['x']-np.max(df.x)):
-		pt2['x'] = np.min(df.x)
-	else:
-		pt2['x'] = np.max(df.x)
-	pt2[dim] = df[df.x == pt2['x']][dim].values[0]
-	return(pt1,pt2)
+	:param array data: 3D array or :py:class:`lazyChannel`
+	:param int factor: Downsampling factor
+	:returns: Downsampled 3D array
+	'''
 
-def calc_rotation(pts,d):
-	dx = (pts.iloc[0].x - pts.iloc[1].x)/2
-	dy = (pts.iloc[0][d] - pts.iloc[1][d])/2
+	return(np.stack([np.asarray(data[z])[::factor,::factor] for z in range(0,data.shape[0],factor)]))
 
-	mp = [pts.iloc[1].x + dx, pts.iloc[1][d] + dy]
+def stratified_sample(df,n,column='z',seed=0):
+	'''
+	Randomly sample approximately `n` rows from `df` with the same fraction of rows taken from each unique value of `column`
 
-	phi = np.arctan2(dy,dx)
-	if d == 'y':
-			A = np.array([[np.cos(phi),-np.sin(phi),0],
-						[np.sin(phi),np.cos(phi),0],
-						[0,0,1]])
-	else:
-		A = np.array([[np.cos(phi),0,-np.sin(phi)],
-						[0,1,0],
-						[np.sin(phi),0,np.cos(phi)]])
+	:param pd.DataFrame df: Dataframe to sample
+	:param int n: Number of rows to sample
+	:param str column: (or None) Column defining the strata, by default z planes
+	:param int seed: (or None) Seed for the random number generator
+	:returns: Sampled dataframe
+	'''
 
-	return(mp,A)
+	frac = min(1,n/len(df))
+	return(df.groupby(column,group_keys=False).sample(frac=frac,random_state=seed))
 
-def cant_correction(df,d):
-    pts = find_anchors(df,d)
-    mp,A = calc_rotation(pts,d)
-    rot = np.dot(np.array(df[['x','y','z']]),A)
-    rdf = pd.DataFrame({'x':rot[:,0],'y':rot[:,1],'z':rot[:,2]})
-    return(rdf)
+def voxel_sample(df,n,columns=['x','y','z'],seed=0):
+	'''
+	Spatially stratified subsample of `df` that keeps at most one point per voxel of a regular grid, with the voxel size chosen so that approximately `n` points are returned
 
-class landmarks:
+	:param pd.DataFrame df: Dataframe containing `columns`
+	:param int n: Maximum number of points to return
+	:param list columns: (or None) Columns defining the position of each point
+	:param int seed: (or None) Seed for the random number generator used if more than `n` voxels are occupied
+	:returns: Subset of `df` in the original order
 	'''
-	Class to handle calculation of landmarks to describe structural data
 
-	:param list percbins: (or None) Must be a list of integers between 0 and 100
-	:param int rnull: (or None) When the r value cannot be calculated it will be set to this value
+	if len(df) <= n:
+		return(df)
 
-	.. py:attribute:: brain.lm_wt_rf
+	xyz = df[columns].to_numpy(dtype='float64')
+	lo = xyz.min(axis=0)
+	ext = np.maximum(xyz.max(axis=0)-lo,1e-6)
+
+	#Points usually lie on a surface so the initial voxel size is estimated from the two largest dimensions
+	size = np.sqrt(np.prod(np.sort(ext)[-2:])/n)
+	order = np.arange(len(xyz))
+	for i in range(4):
+		ijk = ((xyz-lo)/size).astype(np.int64)
+		dims = ijk.max(axis=0)+1
+		key = np.ravel_multi_index(ijk.T,dims)
+
+		#First point in each occupied voxel
+		if np.prod(dims) <= 8*len(key):
+			first = np.full(np.prod(dims),len(key))
+			np.minimum.at(first,key,order)
+			idx = first[first<len(key)]
+		else:
+			u,idx = np.unique(key,return_index=True)
 
-		pd.DataFrame, which wildtype landmarks will be added to
+		if len(idx) >= n/2:
+			break
+		size = size*np.sqrt(len(idx)/n)
 
-	.. py:attribute:: brain.lm_mt_rf
+	if len(idx) > n:
+		idx = np.random.default_rng(seed).choice(idx,n,replace=False)
 
-		pd.DataFrame, which mutant landmarks will be added to
+	return(df.iloc[np.sort(idx)])
 
-	.. py:attribute:: brain.rnull
+def hist_projection(ax,u,v,bins=256,cmap='Greys'):
+	'''
+	Plot the density of points in a 2D projection as an image instead of a scatter plot
 
-		Integer specifying the value which null landmark calculations will be set to
+	:param plt.axis ax: Axis to plot on
+	:param array u: Values on the horizontal axis
+	:param array v: Values on the vertical axis
+	:param int bins: (or None) Number of bins in each dimension
+	:param str cmap: (or None) Matplotlib colormap
+	'''
 
-	.. py:attribute:: brain.percbins
+	H,ue,ve = np.histogram2d(u,v,bins=bins)
+	ax.imshow(np.log1p(H.T),origin='lower',extent=[ue[0],ue[-1],ve[0],ve[-1]],cmap=cmap)
 
-		Integer specifying the percentiles which will be used to calculate landmarks
+def pca_angles(pca,ref):
 	'''
+	Calculate the angle between each component of two fitted PCA objects ignoring the sign of the components
 
-	def __init__(self,percbins=[10,50,90],rnull=15):
+	:param PCA pca: Fitted sklearn.decomposition.PCA
+	:param PCA ref: Fitted sklearn.decomposition.PCA used as the reference
+	:returns: Array of angles in degrees for each component
+	'''
 
-		self.lm_wt_rf = pd.DataFrame()
-		self.lm_mt_rf = pd.DataFrame()
+	dot = np.abs(np.sum(pca.components_*ref.components_,axis=1))
+	return(np.degrees(np.arccos(np.clip(dot,0,1))))
 
-		self.rnull = rnull
-		self.percbins = percbins
+class lazyChannel:
+	'''
+	Read only view of one channel of an hdf5 probability dataset that reads data from the file when it is indexed
 
-	def calc_bins(self,Ldf,ac_num,tstep):
-		'''
-		Calculates alpha and theta bins based on ac_num and tstep
+	Indexing follows numpy with the channel axis removed, e.g. ``lc[z0:z1]`` returns an array of shape [z1-z0,y,x]
 
-		Creates :py:attr:`landmarks.acbins` and :py:attr:`landmarks.tbins`
+	:param h5py.Dataset dataset: Dataset of shape [z,y,x,c] or [z,y,x]
+	:param int channel: (or None) Index of the channel in the last axis of `dataset`
 
-		.. warning:: `tstep` does not handle scenarios where 2pi is not evenly divisible by tstep
+	.. py:attribute:: lazyChannel.shape
 
-		:param dict Ldf: Dict dataframes that are being used for the analysis
-		:param int ac_num: Integer indicating the number of divisions that should be made along alpha
-		:param float tstep: The size of each bin used for alpha
+		Shape [z,y,x] of the channel
 
-		.. py:attribute:: landmarks.acbins
+	.. py:attribute:: lazyChannel.slab
 
-			List containing the boundaries of each bin along alpha based on `ac_num`
+		Number of z planes in each chunk of the dataset, used as the default slab size when reading the channel in pieces
+	'''
 
-		.. py:attribute:: landmarks.tbins
+	def __init__(self,dataset,channel=None):
 
-			List containing the boundaries of each bin along theta based on `tstep`
-		'''
+		self.dataset = dataset
+		self.channel = channel
+		self.shape = dataset.shape[:3]
+		self.dtype = dataset.dtype
+		self.ndim = 3
+		if dataset.chunks != None:
+			self.slab = dataset.chunks[0]
+		else:
+			self.slab = 16
 
-		Ldf = Ldf.values()
+	def __len__(self):
+		return(self.shape[0])
 
-		#Find the minimum and maximum values of alpha in the dataset
-		acmin,acmax = 0,0
-		for df in Ldf:
-			if df.ac.min() < acmin:
-				acmin = df.ac.min()
-			if df.ac.max() > acmax:
-				acmax = df.ac.max()
+	def __getitem__(self,key):
+		if self.channel == None:
+			return(self.dataset[key])
 
-		#Correct min and max values so that arclength is equal on each side
-		if abs(acmin) > acmax:
-			self.acbins = np.linspace(acmin,abs(acmin),ac_num)
-		else:
-			self.acbins = np.linspace(-acmax,acmax,ac_num)
+		if type(key) != tuple:
+			key = (key,)
+		key = key + (slice(None),)*(3-len(key)) + (self.channel,)
+		return(self.dataset[key])
 
-		#Calculate tbins divisions based on tstep
-		self.tbins = np.arange(-np.pi,np.pi+tstep,tstep)
+	def __array__(self,dtype=None,copy=None):
+		arr = self[:]
+		if dtype != None:
+			arr = arr.astype(dtype)
+		return(arr)
 
-	def calc_perc(self,df,snum,dtype,out):
-		'''
-		Calculate landmarks for a dataframe based on the bins and percentiles that have been previously defined
+def read_lazy_channel(filepath,nsample=8):
+	'''
+	Open an hdf5 probability file and return the signal channel without loading it into memory
 
-		:param pd.DataFrame df: Dataframe containing columns x,y,z,alpha,r,theta
-		:param str snum: String containing a sample identifier that can be converted to an integer
-		:param str dtype: String describing the sample group to which the sample belongs, e.g. control or experimental
-		:returns: pd.DataFrame with new landmarks appended
-		'''
+	The channel is selected with the same test as :py:func:`brain.read_data` applied to `nsample` evenly spaced z planes. Uncompressed, unchunked datasets are returned as a `np.memmap`, otherwise a :py:class:`lazyChannel` is returned.
 
-		D = {'stype':dtype}
+	:param str filepath: Filepath to hdf5 probability file
+	:param int nsample: Number of z planes used to select the channel
+	:returns: np.memmap or :py:class:`lazyChannel` of shape [z,y,x]
+	'''
 
-		#Go through each arclength bins
-		for a in range(len(self.acbins)):
-			if a+1 < len(self.acbins):
-				arange = [self.acbins[a],self.acbins[a+1]]
+	f = h5py.File(filepath,'r')
 
-				#Go through each theta bin
-				for t in range(len(self.tbins)):
-					if t+1 < len(self.tbins):
-						trange = [self.tbins[t],self.tbins[t+1]]
+	d = f.get('exported_data')
+	if d != None:
+		Ld,Lch = [d,d],[0,1]
+	else:
+		Ld,Lch = [f.get('channel0'),f.get('channel1')],[None,None]
 
-						#Go through each percentile
-						for p in self.percbins:
-							d = df[(df.ac > arange[0]) & (df.ac < arange[1])]
-							d = d[(d.theta > trange[0]) & (d.theta < trange[1])]
+	#Sample z planes from the first channel
+	zs = np.unique(np.linspace(0,Ld[0].shape[0]-1,min(nsample,Ld[0].shape[0])).astype(int))
+	if Lch[0] == None:
+		c1 = Ld[0][list(zs)]
+	else:
+		c1 = Ld[0][list(zs),:,:,Lch[0]]
 
-							#Try to calculate percentile, but set to null if it fails
-							try:
-								r = np.percentile(d.r,p)
-								pts = d[d.r < r].count()['i']
-							except:
-								r = self.rnull
-								pts = 0
+	#Figure out which channels has more zeros and therefore is background
+	if np.count_nonzero(c1<0.1) > np.count_nonzero(c1>0.9):
+		d,ch = Ld[1],Lch[1]
+	else:
+		d,ch = Ld[0],Lch[0]
+
+	#Memory map data that is stored contiguously without compression
+	offset = d.id.get_offset()
+	if (d.chunks == None) and (d.compression == None) and (offset != None):
+		mm = np.memmap(filepath,dtype=d.dtype,mode='r',offset=offset,shape=d.shape)
+		if ch == None:
+			return(mm)
+		else:
+			return(mm[...,ch])
 
-							#Create name of column based on bins
-							L = []
-							for s in [arange[0],arange[1],trange[0],trange[1]]:
-								L.append(str(np.around(s,decimals=2)))
-							name = '_'.join(L)
+	return(lazyChannel(d,ch))
+
+class math_model:
+	'''
+	Object to contain attributes associated with the math model of a sample
+
+	:param array model: Array of coefficients calculated by np.polyfit
+
+	.. py:attribute:: math_model.cf
+
+		Array of coefficients for the math model
+
+	.. py:attribute:: math_model.p
+
+		Poly1d function for the math model to allow calculation and plotting of the model
+	'''
+
+	def __init__(self,model):
+
+		self.cf = model
+		self.p = np.poly1d(model)
+
+####### Stage cache #########
+
+class stageCache:
+	'''
+	Content addressed cache of intermediate results of the :py:class:`brain` pipeline, e.g. :py:attr:`brain.df_thresh`, :py:attr:`brain.pcamed` and :py:attr:`brain.df_align`
+
+	Keys are built from a hash of the contents of the input file, the name of the stage and the parameters that affect the stage. Entries are held in memory and, if `path` is defined, saved to compressed hdf5 files so that they can be reused by later sessions. The least recently used entries are removed when memory or the files in `path` exceed `maxbytes`.
+
+	:param str path: (or None) Directory where entries are saved
+	:param int maxbytes: (or None) Maximum number of bytes held in memory and on disk
+
+	.. py:attribute:: stageCache.entries
+
+		OrderedDict of entries in memory with the most recently used entry last
+
+	.. py:attribute:: stageCache.hits
+
+		Number of requests that were answered by an existing entry
+
+	.. py:attribute:: stageCache.misses
+
+		Number of requests that did not find an entry
+	'''
+
+	def __init__(self,path=None,maxbytes=2*1024**3):
+
+		self.path = path
+		self.maxbytes = maxbytes
+		self.entries = OrderedDict()
+		self.nbytes = {}
+		self.hashes = {}
+		self.hits,self.misses = 0,0
+
+	def file_hash(self,filepath,blocksize=2**24):
+		'''
+		Calculate the md5 hash of the contents of a file. Hashes are remembered until the size or modification time of the file changes
+
+		:param str filepath: Complete filepath
+		:param int blocksize: (or None) Number of bytes read at a time
+		:returns: Hexadecimal string
+		'''
+
+		st = os.stat(filepath)
+		fid = (os.path.abspath(filepath),st.st_size,st.st_mtime)
+
+		if fid not in self.hashes:
+			md5 = hashlib.md5()
+			with open(filepath,'rb') as f:
+				for block in iter(lambda: f.read(blocksize),b''):
+					md5.update(block)
+			self.hashes[fid] = md5.hexdigest()
+
+		return(self.hashes[fid])
+
+	def make_key(self,filepath,stage,params):
+		'''
+		Calculate the key for a stage of the pipeline
+
+		:param str filepath: Complete filepath to the input file
+		:param str stage: Name of the stage, e.g. ``df_thresh``
+		:param dict params: Parameters that affect the result of the stage
+		:returns: Hexadecimal string
+		'''
+
+		D = {'file':self.file_hash(filepath),'stage':stage,'params':params}
+		return(hashlib.md5(json.dumps(D,sort_keys=True,default=str).encode()).hexdigest())
+
+	def filepath(self,key):
+		'''
+		Path to the file for a key in :py:attr:`stageCache.path`
+
+		:param str key: Key created by :py:func:`stageCache.make_key`
+		:returns: Complete filepath
+		'''
+
+		return(os.path.join(self.path,'stage_'+key+'.hdf5'))
+
+	def get(self,key):
+		'''
+		Return an entry from memory or disk
+
+		:param str key: Key created by :py:func:`stageCache.make_key`
+		:returns: Tuple of a dictionary of dataframes and a dictionary of other objects, copied from the cache, or None if the key is not found
+		'''
+
+		if key in self.entries:
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return(self.copy_entry(*self.entries[key]))
+
+		if (self.path != None) and os.path.isfile(self.filepath(key)):
+			self.hits += 1
+			fpath = self.filepath(key)
+			os.utime(fpath)
+
+			f = h5py.File(fpath,'r')
+			frames = {}
+			for name in f.attrs['frames'].split(','):
+				if name != '':
+					g = f[name]
+					frames[name] = pd.DataFrame({c:g[c][:] for c in g.attrs['columns'].split(',')},
+						index=g['index'][:])
+			objects = pickle.loads(f.attrs['objects'].tobytes())
+			f.close()
+
+			self.remember(key,frames,objects)
+			return(frames,objects)
+
+		self.misses += 1
+		return(None)
+
+	def put(self,key,frames,objects={}):
+		'''
+		Add an entry to memory and save it to disk if :py:attr:`stageCache.path` is defined
+
+		:param str key: Key created by :py:func:`stageCache.make_key`
+		:param dict frames: Dictionary of dataframes with numeric columns
+		:param dict objects: (or None) Dictionary of other objects that can be pickled, e.g. a PCA object
+		'''
+
+		self.remember(key,frames,objects)
+
+		if self.path != None:
+			os.makedirs(self.path,exist_ok=True)
+			fpath = self.filepath(key)
+
+			#Write to a temporary file first so other processes never read a partial entry
+			tmp = fpath+'.'+str(os.getpid())
+			f = h5py.File(tmp,'w')
+			f.attrs['frames'] = ','.join(frames.keys())
+			f.attrs['objects'] = np.void(pickle.dumps(objects))
+			for name,df in frames.items():
+				g = f.create_group(name)
+				g.attrs['columns'] = ','.join(df.columns)
+				g.create_dataset('index',data=np.asarray(df.index),compression='gzip',shuffle=True)
+				for c in df.columns:
+					g.create_dataset(c,data=df[c].values,compression='gzip',shuffle=True)
+			f.close()
+			os.replace(tmp,fpath)
+
+			self.evict_files()
+
+	def copy_entry(self,frames,objects):
+		'''
+		Copy the dataframes and objects of an entry so that changes by the caller do not modify the cache
+
+		:param dict frames: Dictionary of dataframes
+		:param dict objects: Dictionary of other objects
+		:returns: Tuple of copied frames and objects
+		'''
+
+		return({k:df.copy() for k,df in frames.items()},copy.deepcopy(objects))
+
+	def remember(self,key,frames,objects):
+		'''
+		Hold a copy of an entry in memory and remove the least recently used entries above :py:attr:`stageCache.maxbytes`
+		'''
+
+		self.entries[key] = self.copy_entry(frames,objects)
+		self.nbytes[key] = sum([df.memory_usage(index=True).sum() for df in frames.values()])
+
+		while (sum(self.nbytes.values()) > self.maxbytes) and (len(self.entries) > 1):
+			k,v = self.entries.popitem(last=False)
+			del self.nbytes[k]
+
+	def evict_files(self):
+		'''
+		Delete the least recently used files in :py:attr:`stageCache.path` until their total size is below :py:attr:`stageCache.maxbytes`
+		'''
+
+		files = glob.glob(os.path.join(self.path,'stage_*.hdf5'))
+		files = sorted(files,key=os.path.getmtime)
+		total = sum([os.path.getsize(f) for f in files])
+
+		while (total > self.maxbytes) and (len(files) > 1):
+			f = files.pop(0)
+			total -= os.path.getsize(f)
+			os.remove(f)
+
+	def clear(self):
+		'''
+		Remove all entries held in memory
+		'''
+
+		self.entries.clear()
+		self.nbytes.clear()
+		self.hits,self.misses = 0,0
+
+#: Process wide :py:class:`stageCache` used by :py:func:`brain.preprocess_data_cached` and :py:func:`brain.calculate_pca_median_cached`
+stage_cache = stageCache()
+
+####### Closest point kernels #########
+
+def closest_x(x,z,cf):
+	'''
+	Find the x position on a degree 1 or 2 model closest to every data point in the xz plane
+
+	For degree 2 models, the cubic :math:`\\frac{d}{dx}\\left[(x-x_p)^2 + (p(x)-z_p)^2\\right] = 0` is solved in closed form, the real root with the minimum distance is selected and polished with :py:func:`refine_closest_x`. For degree 1 models, the point is projected onto the line.
+
+	:param np.array x: Array of x values of the data points
+	:param np.array z: Array of z values of the data points
+	:param array cf: Coefficients of the model, :py:attr:`math_model.cf`
+	:returns: Array of x positions on the curve closest to each data point
+	:rtype: np.array
+	'''
+
+	x = np.asarray(x,dtype='float64')
+	z = np.asarray(z,dtype='float64')
+
+	if (len(cf) == 3) and (cf[0] != 0):
+		a,b,c = cf
+	elif len(cf) in [2,3]:
+		m,c = cf[-2],cf[-1]
+		return((x + m*(z-c))/(1 + m**2))
+	else:
+		raise ValueError('Closest point calculation requires a degree 1 or 2 math model')
+
+	#Normalized cubic x^3 + A x^2 + B x + C = 0
+	A = 3*b/(2*a)
+	B = (b**2 + 2*a*(c-z) + 1)/(2*a**2)
+	C = (b*(c-z) - x)/(2*a**2)
+
+	#Depressed cubic t^3 + p t + q = 0 with x = t - A/3
+	p = B - A**2/3
+	q = 2*A**3/27 - A*B/3 + C
+	disc = (q/2)**2 + (p/3)**3
+
+	with np.errstate(invalid='ignore',divide='ignore'):
+		#One real root
+		sq = np.sqrt(np.abs(disc))
+		t1 = np.cbrt(-q/2 + sq) + np.cbrt(-q/2 - sq)
+
+		#Three real roots
+		m = 2*np.sqrt(np.abs(p)/3)
+		phi = np.arccos(np.clip(3*q/(p*m),-1,1))/3
+		Lt = [m*np.cos(phi - 2*np.pi*k/3) for k in range(3)]
+
+	three = (disc < 0) & (p < 0)
+	xc = np.where(three,Lt[0],t1) - A/3
+
+	#Select the root with the minimum distance when three real roots exist
+	dist = (xc-x)**2 + (np.polyval(cf,xc)-z)**2
+	for t in Lt[1:]:
+		xt = t - A/3
+		dt = (xt-x)**2 + (np.polyval(cf,xt)-z)**2
+		better = three & (dt < dist)
+		xc = np.where(better,xt,xc)
+		dist = np.where(better,dt,dist)
+
+	#Polish roots with a Newton step on the original cubic
+	xc = refine_closest_x(xc,x,z,cf,n=1)
+
+	return(xc)
+
+def refine_closest_x(xc,x,z,cf,n=1):
+	'''
+	Improve estimates of the closest point on a degree 2 model with Newton steps on the cubic solved by :py:func:`closest_x`. Estimates for degree 1 models are already exact and are returned unchanged.
+
+	:param np.array xc: Array of estimated x positions on the curve
+	:param np.array x: Array of x values of the data points
+	:param np.array z: Array of z values of the data points
+	:param array cf: Coefficients of the model, :py:attr:`math_model.cf`
+	:param int n: Number of Newton steps to take
+	:returns: Array of refined x positions on the curve
+	:rtype: np.array
+	'''
+
+	if len(cf) != 3:
+		return(xc)
+
+	a,b,c = cf
+	c1 = b**2 + 2*a*(c-z) + 1
+	c0 = b*(c-z) - x
+
+	for i in range(n):
+		f = ((2*a**2*xc + 3*a*b)*xc + c1)*xc + c0
+		fp = (6*a**2*xc + 6*a*b)*xc + c1
+		xc = xc - np.where(fp != 0,f/np.where(fp != 0,fp,1),0)
+
+	return(xc)
+
+def model_arclength(xc,cf):
+	'''
+	Calculate arclength between the vertex (x=0) and each position in `xc` using the closed form integral of a degree 1 or 2 model
+
+	.. math::
+
+		\\int_{x_c}^{0} \\sqrt{1 + (2ax + b)^2} = \\frac{G(b) - G(2ax_c + b)}{4a}, \\quad G(u) = u\\sqrt{1+u^2} + \\sinh^{-1}(u)
+
+	:param np.array xc: Array of positions in the x axis along the curve
+	:param array cf: Coefficients of the model, :py:attr:`math_model.cf`
+	:returns: Array of arclengths with the same sign convention as :py:func:`brain.find_arclength`
+	:rtype: np.array
+	'''
+
+	xc = np.asarray(xc)
+	if (len(cf) == 3) and (cf[0] != 0):
+		a,b = cf[0],cf[1]
+		G = lambda u: u*np.sqrt(1+u**2) + np.arcsinh(u)
+		return((G(b) - G(2*a*xc + b))/(4*a))
+	else:
+		return(-xc*np.sqrt(1 + cf[-2]**2))
+
+def nearest_point_numpy(x,y,z,cf):
+	'''
+	NumPy implementation of :py:func:`nearest_point_kernel`
+
+	:returns: Arrays of xc, r and ac
+	'''
+
+	xc = closest_x(x,z,cf)
+	zc = np.polyval(cf,xc)
+	r = np.sqrt((x-xc)**2 + np.asarray(y)**2 + (z-zc)**2)
+	ac = model_arclength(xc,cf)
+
+	return(xc,r,ac)
+
+if numba != None:
+
+	@numba.njit(cache=True)
+	def nearest_point_numba_loop(x,y,z,a,b,c,xc,r,ac):
+		'''
+		Compiled loop for :py:func:`nearest_point_numba` that fills the preallocated arrays `xc`, `r` and `ac`
+		'''
+
+		for i in range(x.shape[0]):
+			px,pz = x[i],z[i]
+
+			if a == 0:
+				xi = (px + b*(pz-c))/(1 + b*b)
+			else:
+				A = 3*b/(2*a)
+				B = (b*b + 2*a*(c-pz) + 1)/(2*a*a)
+				C = (b*(c-pz) - px)/(2*a*a)
+				p = B - A*A/3
+				q = 2*A*A*A/27 - A*B/3 + C
+				disc = (q/2)**2 + (p/3)**3
+
+				if (disc >= 0) or (p >= 0):
+					sq = np.sqrt(abs(disc))
+					u,v = -q/2 + sq,-q/2 - sq
+					xi = np.sign(u)*abs(u)**(1/3) + np.sign(v)*abs(v)**(1/3) - A/3
+				else:
+					m = 2*np.sqrt(-p/3)
+					arg = min(max(3*q/(p*m),-1.0),1.0)
+					phi = np.arccos(arg)/3
+					best = np.inf
+					xi = 0.0
+					for k in range(3):
+						xt = m*np.cos(phi - 2*np.pi*k/3) - A/3
+						zt = (a*xt + b)*xt + c
+						d = (xt-px)**2 + (zt-pz)**2
+						if d < best:
+							best = d
+							xi = xt
+
+				#Newton step on the original cubic
+				c1 = b*b + 2*a*(c-pz) + 1
+				f = ((2*a*a*xi + 3*a*b)*xi + c1)*xi + b*(c-pz) - px
+				fp = (6*a*a*xi + 6*a*b)*xi + c1
+				if fp != 0:
+					xi = xi - f/fp
+
+			zi = (a*xi + b)*xi + c
+			xc[i] = xi
+			r[i] = np.sqrt((px-xi)**2 + y[i]**2 + (pz-zi)**2)
+			if a == 0:
+				ac[i] = -xi*np.sqrt(1 + b*b)
+			else:
+				u0,u1 = b,2*a*xi + b
+				ac[i] = (u0*np.sqrt(1+u0*u0) + np.arcsinh(u0) - u1*np.sqrt(1+u1*u1) - np.arcsinh(u1))/(4*a)
+
+def nearest_point_numba(x,y,z,cf):
+	'''
+	Numba implementation of :py:func:`nearest_point_kernel`
+
+	:returns: Arrays of xc, r and ac
+	'''
+
+	if len(cf) == 3:
+		a,b,c = [float(v) for v in cf]
+	elif len(cf) == 2:
+		a,b,c = 0.0,float(cf[0]),float(cf[1])
+	else:
+		raise ValueError('Closest point calculation requires a degree 1 or 2 math model')
+
+	x = np.ascontiguousarray(x,dtype='float64')
+	y = np.ascontiguousarray(y,dtype='float64')
+	z = np.ascontiguousarray(z,dtype='float64')
+	xc,r,ac = np.empty(x.shape[0]),np.empty(x.shape[0]),np.empty(x.shape[0])
+
+	nearest_point_numba_loop(x,y,z,a,b,c,xc,r,ac)
+	return(xc,r,ac)
+
+def nearest_point_kernel(x,y,z,cf,engine=None):
+	'''
+	Calculate the closest point on a degree 1 or 2 model, the distance to the model and the arclength along the model for arrays of points in one pass
+
+	:param np.array x: Array of x values of the data points
+	:param np.array y: Array of y values of the data points
+	:param np.array z: Array of z values of the data points
+	:param array cf: Coefficients of the model, :py:attr:`math_model.cf`
+	:param str engine: (or None) ``'numba'`` or ``'numpy'``. By default numba is used if it is installed.
+	:returns: Arrays of xc, r and ac
+	:rtype: np.array
+	'''
+
+	if engine == None:
+		engine = 'numpy' if numba == None else 'numba'
+
+	if engine == 'numba':
+		if numba == None:
+			raise ImportError('numba is not installed, use engine=\'numpy\'')
+		return(nearest_point_numba(x,y,z,cf))
+	elif engine == 'numpy':
+		return(nearest_point_numpy(x,y,z,cf))
+	else:
+		raise ValueError('Unknown engine: '+str(engine))
+
+####### Alignment correction functions#########
+
+def find_anchors(df,dim):
+	''':param str dim: either y or z'''
+	mm = math_model(np.polyfit(df['x'],df[dim],2))
+
+	pt1 = {}
+	if mm.cf[0] > 0:
+		pt1[dim] = np.max(df[dim])
+	else:
+		pt1[dim] = np.min(df[dim])
+	pt1['x'] = df[df[dim] == pt1[dim]].x.values[0]
+
+	pt2 = {}
+	if abs(pt1['x']-np.min(df.x)) > abs(pt1['x']-np.max(df.x)):
+		pt2['x'] = np.min(df.x)
+	else:
+		pt2['x'] = np.max(df.x)
+	pt2[dim] = df[df.x == pt2['x']][dim].values[0]
+	return(pt1,pt2)
+
+def calc_rotation(pts,d):
+	dx = (pts.iloc[0].x - pts.iloc[1].x)/2
+	dy = (pts.iloc[0][d] - pts.iloc[1][d])/2
+
+	mp = [pts.iloc[1].x + dx, pts.iloc[1][d] + dy]
+
+	phi = np.arctan2(dy,dx)
+	if d == 'y':
+			A = np.array([[np.cos(phi),-np.sin(phi),0],
+						[np.sin(phi),np.cos(phi),0],
+						[0,0,1]])
+	else:
+		A = np.array([[np.cos(phi),0,-np.sin(phi)],
+						[0,1,0],
+						[np.sin(phi),0,np.cos(phi)]])
+
+	return(mp,A)
+
+def cant_correction(df,d):
+    pts = find_anchors(df,d)
+    mp,A = calc_rotation(pts,d)
+    rot = np.dot(np.array(df[['x','y','z']]),A)
+    rdf = pd.DataFrame({'x':rot[:,0],'y':rot[:,1],'z':rot[:,2]})
+    return(rdf)
+
+class landmarks:
+	'''
+	Class to handle calculation of landmarks to describe structural data
+
+	:param list percbins: (or None) Must be a list of integers between 0 and 100
+	:param int rnull: (or None) When the r value cannot be calculated it will be set to this value
+
+	.. py:attribute:: brain.lm_wt_rf
+
+		pd.DataFrame, which wildtype landmarks will be added to
+
+	.. py:attribute:: brain.lm_mt_rf
+
+		pd.DataFrame, which mutant landmarks will be added to
+
+	.. py:attribute:: brain.rnull
+
+		Integer specifying the value which null landmark calculations will be set to
+
+	.. py:attribute:: brain.percbins
+
+		Integer specifying the percentiles which will be used to calculate landmarks
+	'''
+
+	def __init__(self,percbins=[10,50,90],rnull=15):
+
+		self.lm_wt_rf = pd.DataFrame()
+		self.lm_mt_rf = pd.DataFrame()
+
+		self.rnull = rnull
+		self.percbins = percbins
+
+		self.lm_arr = {}
+		self.pts_arr = {}
+
+	def calc_bins(self,Ldf,ac_num,tstep):
+		'''
+		Calculates alpha and theta bins based on ac_num and tstep
+
+		Creates :py:attr:`landmarks.acbins` and :py:attr:`landmarks.tbins`
+
+		.. warning:: `tstep` does not handle scenarios where 2pi is not evenly divisible by tstep
+
+		:param dict Ldf: Dict dataframes that are being used for the analysis
+		:param int ac_num: Integer indicating the number of divisions that should be made along alpha
+		:param float tstep: The size of each bin used for alpha
+
+		.. py:attribute:: landmarks.acbins
+
+			List containing the boundaries of each bin along alpha based on `ac_num`
+
+		.. py:attribute:: landmarks.tbins
+
+			List containing the boundaries of each bin along theta based on `tstep`
+		'''
 
-							D[name+'_'+str(p)+'_pts'] = pts
-							D[name+'_'+str(p)+'_r'] = r
+		Ldf = Ldf.values()
+
+		#Find the minimum and maximum values of alpha in the dataset
+		acmin,acmax = 0,0
+		for df in Ldf:
+			if df.ac.min() < acmin:
+				acmin = df.ac.min()
+			if df.ac.max() > acmax:
+				acmax = df.ac.max()
 
-		out = out.append(pd.Series(D,name=int(snum)))
+		#Correct min and max values so that arclength is equal on each side
+		if abs(acmin) > acmax:
+			self.acbins = np.linspace(acmin,abs(acmin),ac_num)
+		else:
+			self.acbins = np.linspace(-acmax,acmax,ac_num)
+
+		#Calculate tbins divisions based on tstep
+		self.tbins = np.arange(-np.pi,np.pi+tstep,tstep)
+
+	def calc_perc(self,df,snum,dtype,out):
+		'''
+		Calculate landmarks for a dataframe based on the bins and percentiles that have been previously defined
+
+		Landmarks are calculated by :py:func:`landmarks.calc_perc_arr` and reformatted into a row with one column per landmark
+
+		:param pd.DataFrame df: Dataframe containing columns x,y,z,alpha,r,theta
+		:param str snum: String containing a sample identifier that can be converted to an integer
+		:param str dtype: String describing the sample group to which the sample belongs, e.g. control or experimental
+		:returns: pd.DataFrame with new landmarks appended
+		'''
+
+		rarr,ptsarr = self.calc_perc_arr(df)
+		self.lm_arr[int(snum)] = rarr
+		self.pts_arr[int(snum)] = ptsarr
+
+		#Columns alternate between pts and r for each landmark
+		names = landmark_names(self.acbins,self.tbins,self.percbins)
+		pts = pd.DataFrame(ptsarr.reshape(1,-1),columns=[n+'_pts' for n in names],index=[int(snum)])
+		r = pd.DataFrame(rarr.reshape(1,-1),columns=[n+'_r' for n in names],index=[int(snum)])
+		cols = np.stack([pts.columns,r.columns],axis=1).ravel()
+
+		D = pd.concat([pd.DataFrame({'stype':dtype},index=[int(snum)]),pts,r],axis=1)
+		out = pd.concat([out,D[['stype']+list(cols)]])
 		return(out)
 
+	def calc_perc_arr(self,df):
+		'''
+		Calculate landmarks for a dataframe as dense arrays using :py:func:`bin_percentiles`
+
+		:param pd.DataFrame df: Dataframe containing columns ac,r,theta
+		:returns: Two arrays with shape (alpha bins, theta bins, percentiles) containing the r value of each percentile and the number of points below that r value
+
+		.. py:attribute:: landmarks.lm_arr
+
+			Dictionary of r arrays calculated by :py:func:`landmarks.calc_perc` with the sample number as the key
+
+		.. py:attribute:: landmarks.pts_arr
+
+			Dictionary of point count arrays calculated by :py:func:`landmarks.calc_perc` with the sample number as the key
+		'''
+
+		return(bin_percentiles(df.ac.values,df.theta.values,df.r.values,
+			self.acbins,self.tbins,self.percbins,self.rnull))
+
 	def calc_wt_reformat(self,df,snum):
 		'''
 		.. warning:: Deprecated function, but includes code pertaining to calculating point based data
@@ -1011,6 +2091,161 @@ class landmarks:
 
 		self.lm_mt_rf = self.lm_mt_rf.append(pd.Series(D,name=int(snum)))
 
+def bin_percentiles(ac,theta,r,acbins,tbins,percbins,rnull=15):
+	'''
+	Calculate percentiles of r and point counts for every alpha and theta bin in a single sort
+
+	Each point is assigned to a bin once with np.digitize. Points are then sorted by bin and r so that each percentile can be read directly from the sorted array using the same linear interpolation as np.percentile. Points that fall on a bin boundary are excluded, which matches the strict inequalities used by previous versions of :py:func:`landmarks.calc_perc`.
+
+	:param np.array ac: Alpha value of each point
+	:param np.array theta: Theta value of each point
+	:param np.array r: R value of each point
+	:param np.array acbins: Boundaries of bins along alpha
+	:param np.array tbins: Boundaries of bins along theta
+	:param list percbins: Percentiles between 0 and 100
+	:param int rnull: (or None) Value given to percentiles in bins that contain no points
+	:returns: Two arrays with shape (alpha bins, theta bins, percentiles) containing the r value of each percentile and the number of points below that r value
+	'''
+
+	ac,theta,r = np.asarray(ac),np.asarray(theta),np.asarray(r)
+	na,nt,npc = len(acbins)-1,len(tbins)-1,len(percbins)
+
+	#Assign bins and discard points outside of bins or on a boundary
+	ai = np.digitize(ac,acbins)-1
+	ti = np.digitize(theta,tbins)-1
+	keep = (ai>=0)&(ai<na)&(ti>=0)&(ti<nt)&(~np.isin(ac,acbins))&(~np.isin(theta,tbins))
+	b = ai[keep]*nt + ti[keep]
+	rs = r[keep]
+
+	#Sort points by bin and then by r
+	order = np.lexsort((rs,b))
+
+	rarr,ptsarr = sorted_bin_percentiles(b[order],rs[order],na*nt,percbins,rnull)
+	return(rarr.reshape(na,nt,npc),ptsarr.reshape(na,nt,npc))
+
+def sorted_bin_percentiles(b,rs,nbins,percbins,rnull=15):
+	'''
+	Calculate percentiles of r and point counts for points that are already sorted by bin and then by r
+
+	:param np.array b: Integer bin index of each point in ascending order
+	:param np.array rs: R value of each point, ascending within each bin
+	:param int nbins: Total number of bins
+	:param list percbins: Percentiles between 0 and 100
+	:param int rnull: (or None) Value given to percentiles in bins that contain no points
+	:returns: Two arrays with shape (bins, percentiles) containing the r value of each percentile and the number of points below that r value
+	'''
+
+	npc = len(percbins)
+
+	n = np.bincount(b,minlength=nbins)
+	start = np.concatenate([[0],np.cumsum(n)[:-1]])
+	full = n > 0
+
+	#First index of each run of tied r values within a bin
+	idx = np.arange(len(rs))
+	new = np.ones(len(rs),dtype=bool)
+	new[1:] = (rs[1:] != rs[:-1]) | (b[1:] != b[:-1])
+	first = np.maximum.accumulate(np.where(new,idx,0))
+
+	rarr = np.full((nbins,npc),rnull,dtype=float)
+	ptsarr = np.zeros((nbins,npc),dtype=int)
+	st,nn = start[full],n[full]
+	for i,p in enumerate(percbins):
+		h = (nn-1)*p/100
+		lo = np.floor(h).astype(int)
+		hi = np.minimum(lo+1,nn-1)
+		g = h-lo
+		rlo,rhi = rs[st+lo],rs[st+hi]
+
+		#Linear interpolation as implemented by np.percentile
+		diff = rhi-rlo
+		val = np.where(g>=0.5,rhi-diff*(1-g),rlo+diff*g)
+
+		#Count points strictly less than the percentile
+		rarr[full,i] = val
+		ptsarr[full,i] = np.where(val>rlo,lo+1,first[st+lo]-st)
+
+	return(rarr,ptsarr)
+
+def landmark_names(acbins,tbins,percbins):
+	'''
+	Create landmark names of the form ``amn_amx_tmn_tmx_p`` in the order alpha bin, theta bin, percentile
+
+	:param np.array acbins: Alpha bin boundaries
+	:param np.array tbins: Theta bin boundaries
+	:param list percbins: Percentiles
+	:returns: List of names that correspond to a flattened array of shape (alpha bins, theta bins, percentiles)
+	'''
+
+	astr = [str(np.around(s,decimals=2)) for s in acbins]
+	tstr = [str(np.around(s,decimals=2)) for s in tbins]
+
+	return(['_'.join([astr[a],astr[a+1],tstr[t],tstr[t+1],str(p)])
+		for a in range(len(acbins)-1) for t in range(len(tbins)-1) for p in percbins])
+
+def parse_landmarks(columns):
+	'''
+	Parse landmark column names of the form ``amn_amx_tmn_tmx_p_dtype`` into a table of bin parameters
+
+	Columns that do not follow this naming scheme, e.g. ``stype``, are ignored
+
+	:param list columns: Column names of a landmark dataframe
+	:returns: pd.DataFrame indexed by column name with float columns amn,amx,tmn,tmx and string columns p,dtype
+	'''
+
+	names = pd.Index(columns).astype(str)
+	parts = names.str.split('_')
+	names = names[parts.str.len()==6]
+
+	lmi = pd.DataFrame(names.str.split('_').tolist(),index=names,
+		columns=['amn','amx','tmn','tmx','p','dtype'])
+	for c in ['amn','amx','tmn','tmx']:
+		lmi[c] = lmi[c].astype(float)
+
+	return(lmi)
+
+def locate_bins(values,arr):
+	'''
+	Find the index of each value in an array of bin values
+
+	:param np.array values: Values to locate
+	:param np.array arr: Array of bin values
+	:returns: Array of indices into `arr` and boolean array that is False for values that are not in `arr`
+	'''
+
+	values,arr = np.asarray(values),np.asarray(arr)
+	if len(arr) == 0:
+		return(np.zeros(len(values),dtype=int),np.zeros(len(values),dtype=bool))
+
+	sorter = np.argsort(arr,kind='stable')
+	pos = np.clip(np.searchsorted(arr,values,sorter=sorter),0,len(arr)-1)
+	idx = sorter[pos]
+
+	return(idx,arr[idx]==values)
+
+def landmark_cells(lmi,xarr,tarr,x,t):
+	'''
+	Find the array cell of each landmark in an index created by :py:func:`parse_landmarks`
+
+	If several landmarks fall into the same cell, only the last one is kept
+
+	:param pd.DataFrame lmi: Landmark index from :py:func:`parse_landmarks`
+	:param np.array xarr: Array of alpha values
+	:param np.array tarr: Array of theta values
+	:param np.array x: Alpha value of each landmark
+	:param np.array t: Theta value of each landmark
+	:returns: List of column names and arrays of the alpha and theta index of each column
+	'''
+
+	xi,xok = locate_bins(x,xarr)
+	ti,tok = locate_bins(t,tarr)
+	ok = xok & tok
+
+	cells = pd.Index(xi*len(tarr)+ti)
+	ok = ok & ~cells.duplicated(keep='last')
+
+	return(lmi.index[ok],xi[ok],ti[ok])
+
 def reformat_to_cart(df):
 	'''
 	Take a dataframe in which columns contain the bin parameters and convert to a cartesian coordinate system
@@ -1019,26 +2254,21 @@ def reformat_to_cart(df):
 	:returns: pd.DataFrame with each landmark as a row and columns: x,y,z,r,r_std,t,pts
 	'''
 
-	ndf = pd.DataFrame()
-	for c in df.columns:
-		if len(c.split('_')) == 6:
-			amn,amx,tmn,tmx,p,dtype = c.split('_')
-			x = np.mean([float(amn),float(amx)])
-			t = np.mean([float(tmn),float(tmx)])
-
-			if dtype == 'r':
-				r = np.mean(df[c])
-				r_std = stats.sem(df[c])
-				y = np.sin(t)*r
-				z = np.cos(t)*r
-
-				pts = np.mean(df['_'.join([amn,amx,tmn,tmx,p,'pts'])])
+	lmi = parse_landmarks(df.columns)
+	lmi = lmi[lmi.dtype=='r']
+	if len(lmi) == 0:
+		return(pd.DataFrame())
 
-				D = pd.Series({'x':x,'y':y,'z':z,'r':r,'r_sem':r_std,'t':t,'pts':pts})
+	x = (lmi.amn.values+lmi.amx.values)/2
+	t = (lmi.tmn.values+lmi.tmx.values)/2
 
-				ndf = ndf.append(pd.Series(D),ignore_index=True)
+	R = df[lmi.index]
+	r = R.mean().values
+	ptscols = lmi.index.str.slice(0,-1)+'pts'
 
-	return(ndf)
+	return(pd.DataFrame({'x':x,'y':np.sin(t)*r,'z':np.cos(t)*r,'r':r,
+		'r_sem':stats.sem(R.to_numpy(dtype=float),axis=0),'t':t,
+		'pts':df[ptscols].mean().values}))
 
 def convert_to_arr(xarr,tarr,DT,mdf,Ldf=[]):
 	'''
@@ -1053,25 +2283,21 @@ def convert_to_arr(xarr,tarr,DT,mdf,Ldf=[]):
 	:param list Ldf: List of additional pd.DataFrames that should also be converted to arrays
 	:returns: Array of the main dataframe and list of arrays converted from Ldf
 	'''
-	marr = np.zeros((len(xarr),len(tarr),len(mdf.index)))
 	xarr = np.round(xarr,2)
 	tarr = np.round(tarr,2)
-	Larr = []
-	for df in Ldf:
-		Larr.append(np.zeros((len(xarr),len(tarr),len(df.index))))
 
-	for c in mdf.columns:
-		if len(c.split('_')) == 6:
-			amn,amx,tmn,tmx,p,dtype = c.split('_')
-			x = float(amn)#np.mean([float(amn),float(amx)])
-			t = float(tmn) #np.mean([float(tmn),float(tmx)])
+	#Landmarks are located by the lower bound of each bin
+	lmi = parse_landmarks(mdf.columns)
+	lmi = lmi[lmi.dtype==DT]
+	cols,xi,ti = landmark_cells(lmi,xarr,tarr,lmi.amn.values,lmi.tmn.values)
 
-			if dtype == DT:
-				marr[np.where(xarr==x)[0],np.where(tarr==t)[0]] = mdf[c]
-				for arr,df in zip(Larr,Ldf):
-					arr[np.where(xarr==x)[0],np.where(tarr==t)[0]] = df[c]
+	Larr = []
+	for df in [mdf]+Ldf:
+		arr = np.zeros((len(xarr),len(tarr),len(df.index)))
+		arr[xi,ti] = df[cols].to_numpy(dtype=float).T
+		Larr.append(arr)
 
-	return(marr,Larr)
+	return(Larr[0],Larr[1:])
 
 def calc_variance(anum,dfs):
 	'''
@@ -1093,7 +2319,7 @@ def calc_variance(anum,dfs):
 		outlm = lm.calc_perc(dfs[k],k,'wt',outlm)
 
 	#Convert to arr for variance calculation
-	lmarr,arr = convert_to_arr(lm.acbins,lm.tbins,outlm)
+	lmarr,arr = convert_to_arr(lm.acbins,lm.tbins,'r',outlm)
 
 	svar = np.var(lmarr,axis=2)
 
@@ -1127,11 +2353,11 @@ class anumSelect:
 
 		.. attribute:: anumSelect.Msv
 
-			List of values of the average sample variance for each anum in the sweep
+			Array of values of the average sample variance for each anum in the sweep
 
 		.. attribute:: anumSelect.Mbv
 
-			List of values of the average bin variance for each anum in the sweep
+			Array of values of the average bin variance for each anum in the sweep
 
 		.. attribute:: anumSelect.Llm
 
@@ -1139,10 +2365,94 @@ class anumSelect:
 
 		'''
 
-		self.dfs = dfs
-		self.Lsv,self.Lbv = [],[]
-		self.Msv,self.Mbv = [],[]
-		self.Llm = []
+		self.dfs = dfs
+		self.Lsv,self.Lbv = [],[]
+		self.Msv,self.Mbv = np.array([]),np.array([])
+		self.Llm = []
+		self.sweep_data = None
+
+	def prepare_sweep(self,tstep):
+		'''
+		Sort each sample by r once and assign theta bins so that landmarks for any anum only require binning along alpha
+
+		:param float tstep: The size of each theta wedge in radians
+
+		.. attribute:: anumSelect.sweep_data
+
+			Dictionary containing the alpha range, theta bins and the sorted ac, theta bin and r arrays of each sample
+		'''
+
+		tbins = np.arange(-np.pi,np.pi+tstep,tstep)
+		nt = len(tbins)-1
+
+		#Each sample is read once, e.g. from a lazyPsiDict, and only the sorted arrays used by the sweep are kept
+		acmin,acmax = 0,0
+		samples = []
+		for k in self.dfs.keys():
+			df = self.dfs[k]
+			ac,theta,r = df.ac.values,df.theta.values,df.r.values
+			del df
+
+			#Find alpha range in the same way as landmarks.calc_bins
+			acmin = min(acmin,ac.min())
+			acmax = max(acmax,ac.max())
+
+			order = np.argsort(r,kind='stable')
+			ac,theta,r = ac[order],theta[order],r[order]
+
+			#Theta bins do not depend on anum
+			ti = np.digitize(theta,tbins)-1
+			keep = (ti>=0)&(ti<nt)&(~np.isin(theta,tbins))
+			samples.append((ac[keep],ti[keep].astype(np.int32),r[keep]))
+
+		self.sweep_data = {'tstep':tstep,'acmin':acmin,'acmax':acmax,'tbins':tbins,'samples':samples}
+
+	def sweep_anum(self,anum,percbins,rnull,DT):
+		'''
+		Calculate landmarks and variances for one value of anum using :py:attr:`anumSelect.sweep_data`
+
+		Points are already sorted by r, so a stable sort by bin index groups points by bin with r in ascending order
+
+		:param int anum: Number of bins which the arclength axis should be divided into
+		:param list percbins: Must be a list of integers between 0 and 100
+		:param int rnull: When the r value cannot be calculated it will be set to this value
+		:param str DT: Data type for which variance is measured, e.g. ``r`` or ``pts``
+		:returns: Landmark array, sample variance array and bin variance array
+		'''
+
+		S = self.sweep_data
+		acmin,acmax,tbins = S['acmin'],S['acmax'],S['tbins']
+
+		if abs(acmin) > acmax:
+			acbins = np.linspace(acmin,abs(acmin),anum)
+		else:
+			acbins = np.linspace(-acmax,acmax,anum)
+		na,nt = len(acbins)-1,len(tbins)-1
+
+		#Landmarks are saved by the lower bound of each bin, see convert_to_arr
+		lmarr = np.zeros((len(acbins),len(tbins),len(S['samples'])))
+		for j,(ac,ti,r) in enumerate(S['samples']):
+			ai = np.digitize(ac,acbins)-1
+			keep = (ai>=0)&(ai<na)&(~np.isin(ac,acbins))
+			b = (ai[keep]*nt + ti[keep]).astype(np.int32)
+			order = np.argsort(b,kind='stable')
+
+			rarr,ptsarr = sorted_bin_percentiles(b[order],r[keep][order],na*nt,percbins[-1:],rnull)
+			if DT == 'r':
+				lmarr[:na,:nt,j] = rarr.reshape(na,nt)
+			else:
+				lmarr[:na,:nt,j] = ptsarr.reshape(na,nt)
+
+		#Calculate variance between samples
+		svar = np.nanvar(lmarr,axis=2)
+
+		#Calculate variance between bins
+		Lvar = []
+		for i in range(1,len(acbins)):
+			for t in range(0,len(tbins)):
+				Lvar.append(np.nanvar(lmarr[i-1:i+2,t],axis=0))
+
+		return(lmarr,svar,np.array(Lvar))
 
 	def calc_variance(self,anum,tstep,percbins,rnull,DT):
 		'''
@@ -1150,45 +2460,30 @@ class anumSelect:
 
 		:param int anum: Number of bins which the arclength axis should be divided into
 		:param float tstep: The size of each bin used for alpha
-		:param dict dfs: Dictionary of dfs which are going to be processed
 		:param list percbins: Must be a list of integers between 0 and 100
 		:param int rnull: When the r value cannot be calculated it will be set to this value
 		:param str DT: Data type for which variance is measured, e.g. ``r`` or ``pts``
 		'''
 
-		#Set up bins
-		lm = landmarks(percbins=percbins,rnull=rnull)
-		lm.calc_bins(self.dfs,anum,tstep)
+		if (self.sweep_data == None) or (self.sweep_data['tstep'] != tstep):
+			self.prepare_sweep(tstep)
 
-		#Calculate landmarks
-		outlm = pd.DataFrame()
-		for k in self.dfs.keys():
-			outlm = lm.calc_perc(self.dfs[k],k,'s',outlm)
+		lmarr,svar,bvar = self.sweep_anum(anum,percbins,rnull,DT)
 
-		#Convert to arr for variance calculations
-		lmarr,arr = convert_to_arr(lm.acbins,lm.tbins,DT,outlm)
 		self.Llm.append(lmarr)
-
-		#Calculate variance between samples
-		svar = np.nanvar(lmarr,axis=2)
-
-		#Calculate variance between bins
-		Lvar = []
-		for i in range(1,len(lm.acbins-2)):
-			for t in range(0,len(lm.tbins)):
-				Lvar.append(np.nanvar(lmarr[i-1:i+2,t],axis=0))
-
 		self.Lsv.append(svar)
-		self.Msv.append(np.nanmean(svar))
-		self.Lbv.append(np.array(Lvar))
-		self.Mbv.append(np.nanmean(np.array(Lvar)))
+		self.Msv = np.append(self.Msv,np.nanmean(svar))
+		self.Lbv.append(bvar)
+		self.Mbv = np.append(self.Mbv,np.nanmean(bvar))
 
 		print(anum,'calculation complete')
 
-	def param_sweep(self,tstep,amn=2,amx=50,astep=1,percbins=[50],rnull=15,DT='pts'):
+	def param_sweep(self,tstep,amn=2,amx=50,astep=1,percbins=[50],rnull=15,DT='pts',workers=None):
 		'''
 		Calculate landmarks for each value of anum specified in input range
 
+		Samples are sorted once by :py:func:`anumSelect.prepare_sweep` and each value of anum is calculated in a thread pool by :py:func:`anumSelect.sweep_anum`
+
 		:param float tstep: The size of each theta wedge in radians
 		:param int amn: The minimum number of alpha bins that should be considered
 		:param int amx: The maximum number of alpha bins that should be considered
@@ -1196,6 +2491,7 @@ class anumSelect:
 		:param list percbins: (or None) Must be a list of integers between 0 and 100
 		:param int rnull: (or None) When the r value cannot be calculated it will be set to this value
 		:param str DT: Default=``pts`` Data type for which variance is measured, e.g. ``r`` or ``pts``
+		:param int workers: (or None) Number of threads, defaults to the number of cpus
 
 		.. attribute:: anumSelect.amn
 
@@ -1210,9 +2506,29 @@ class anumSelect:
 			The step size in the range of amn to amx
 		'''
 		self.amn,self.amx,self.astep = amn,amx,astep
+		anums = np.arange(self.amn,self.amx,self.astep)
+
+		self.prepare_sweep(tstep)
+
+		if workers == None:
+			workers = mp.cpu_count()
 
-		for a in np.arange(self.amn,self.amx,self.astep):
-			self.calc_variance(a,tstep,percbins,rnull,DT)
+		def sweep(a):
+			return(self.sweep_anum(a,percbins,rnull,DT))
+
+		if workers == 1:
+			results = list(map(sweep,anums))
+		else:
+			pool = ThreadPool(workers)
+			results = pool.map(sweep,anums)
+			pool.close()
+			pool.join()
+
+		self.Llm = [res[0] for res in results]
+		self.Lsv = [res[1] for res in results]
+		self.Lbv = [res[2] for res in results]
+		self.Msv = np.array([np.nanmean(res[1]) for res in results])
+		self.Mbv = np.array([np.nanmean(res[2]) for res in results])
 
 		print('Parameter sweep complete')
 
@@ -1281,6 +2597,116 @@ class anumSelect:
 		ax.set_xlabel('Number of Alpha Bins')
 		ax.set_ylabel('Relative Variance')
 
+def permutation_batch(X,M,na,obs,nperm,seed):
+	'''
+	Count permutations of sample labels with a difference of means at least as extreme as the observed difference
+
+	:param np.array X: Array of shape (landmarks, samples) with nan values replaced by 0
+	:param np.array M: Array of shape (landmarks, samples) that is 1 for valid values and 0 for nan values
+	:param int na: Number of samples in the first group
+	:param np.array obs: Observed absolute difference of means for each landmark
+	:param int nperm: Number of permutations in this batch
+	:param int seed: Seed or seed sequence for the random number generator
+	:returns: Array with the number of extreme permutations for each landmark
+	'''
+
+	rng = np.random.default_rng(seed)
+	n = X.shape[1]
+
+	#Each row assigns samples to the first group
+	G = np.zeros((nperm,n))
+	G[:,:na] = 1
+	G = rng.permuted(G,axis=1)
+
+	Sa,Ca = X.dot(G.T),M.dot(G.T)
+	Sb = X.sum(axis=1)[:,np.newaxis] - Sa
+	Cb = M.sum(axis=1)[:,np.newaxis] - Ca
+	with np.errstate(divide='ignore',invalid='ignore'):
+		diff = np.abs(Sa/Ca - Sb/Cb)
+
+	#Tolerance avoids missing permutations that equal the observed value up to rounding
+	return(np.sum(diff >= obs[:,np.newaxis]-1e-12*np.abs(obs[:,np.newaxis]),axis=1))
+
+def permutation_test(a,b,nperm=10000,seed=0,workers=1,batch=1000):
+	'''
+	Two sided permutation test of the difference of means for every landmark at once, ignoring nan values
+
+	:param np.array a: Array of shape (alpha, theta, samples) for the first group
+	:param np.array b: Array of shape (alpha, theta, samples) for the second group
+	:param int nperm: (or None) Number of random permutations
+	:param int seed: (or None) Seed for the random number generator
+	:param int workers: (or None) Number of processes used to evaluate batches of permutations
+	:param int batch: (or None) Maximum number of permutations evaluated with one matrix product
+	:returns: Array of shape (alpha, theta) containing the difference of means, a - b, and array of p values
+	'''
+
+	shape = a.shape[:-1]
+	na = a.shape[-1]
+	X = np.concatenate([a.reshape(-1,na),b.reshape(-1,b.shape[-1])],axis=1)
+	M = (~np.isnan(X)).astype(float)
+	X = np.where(M>0,X,0)
+
+	with np.errstate(divide='ignore',invalid='ignore'):
+		obs = np.nanmean(a.reshape(-1,na),axis=1) - np.nanmean(b.reshape(-1,b.shape[-1]),axis=1)
+
+	seeds = np.random.SeedSequence(seed).spawn(int(np.ceil(nperm/batch)))
+	sizes = [min(batch,nperm-i*batch) for i in range(len(seeds))]
+	args = [(X,M,na,np.abs(obs),n,sd) for n,sd in zip(sizes,seeds)]
+
+	if workers == 1:
+		counts = [permutation_batch(*arg) for arg in args]
+	else:
+		pool = mp.Pool(workers)
+		counts = pool.starmap(permutation_batch,args)
+		pool.close()
+		pool.join()
+
+	pvals = (np.sum(counts,axis=0)+1)/(nperm+1)
+	pvals[np.isnan(obs)] = np.nan
+
+	return(obs.reshape(shape),pvals.reshape(shape))
+
+def bh_correction(pvals):
+	'''
+	Benjamini-Hochberg correction of p values for the false discovery rate, ignoring nan values
+
+	:param np.array pvals: Array of p values of any shape
+	:returns: Array of adjusted p values with the same shape as `pvals`
+	'''
+
+	p = np.asarray(pvals,dtype=float).ravel()
+	valid = np.flatnonzero(~np.isnan(p))
+	m = len(valid)
+
+	order = valid[np.argsort(p[valid],kind='stable')]
+	adj = p[order]*m/np.arange(1,m+1)
+
+	#Adjusted p values must not decrease with rank
+	adj = np.minimum.accumulate(adj[::-1])[::-1]
+
+	out = np.full(p.shape,np.nan)
+	out[order] = np.minimum(adj,1)
+	return(out.reshape(np.shape(pvals)))
+
+def landmark_key(rawdf,xarr,tarr,dtype):
+	'''
+	Hash of a landmark dataframe and the configuration used to convert it to an array
+
+	:param pd.DataFrame rawdf: Landmark dataframe with each column as a landmark
+	:param arr xarr: List of min and max borders of the alpha bins
+	:param arr tarr: List of min and max borders of the theta bins
+	:param str dtype: Either ``pts`` or ``r``
+	:returns: Hex digest string
+	'''
+
+	md5 = hashlib.md5()
+	md5.update(pd.util.hash_pandas_object(rawdf,index=True).values.tobytes())
+	md5.update(','.join(map(str,rawdf.columns)).encode())
+	md5.update(np.asarray(xarr,dtype=float).tobytes())
+	md5.update(np.asarray(tarr,dtype=float).tobytes())
+	md5.update(str(dtype).encode())
+	return(md5.hexdigest())
+
 class graphSet:
 
 	def __init__(self,tpairs,xarr,tarr):
@@ -1303,12 +2729,18 @@ class graphSet:
 		.. attribute:: graphSet.tarr
 
 			Array listing the bin division points along theta
+
+		.. attribute:: graphSet.summary
+
+			True if the data was read by :py:func:`read_graph_summary`, in which case p values are not recalculated
 		'''
 
 		self.tpairs,self.xarr,self.tarr = tpairs,xarr,tarr
 
 		self.Ls,self.Lc = [],[]
 		self.Ds, self.Dc = {},{}
+		self.Dp,self.pkey = {},None
+		self.summary = False
 
 	def add_data(self,gD,stype,ctype,dtype):
 		'''
@@ -1370,20 +2802,125 @@ class graphSet:
 			for j in range(J):
 				self.axr[i,j].legend()
 
-	def make_figure(self,a,mt_key,figsize=(10,8),P=True,pthresh=None,cbar=False):
+	def calc_pvalues(self,test='ttest',nperm=10000,correction=None,workers=1,seed=0):
+		'''
+		Compare the first two stypes for each ctype at every landmark
+
+		:param str test: (or None) Either ``ttest`` for `stats.ttest_ind` or ``permutation`` for :py:func:`permutation_test`
+		:param int nperm: (or None) Number of permutations if `test` is ``permutation``
+		:param str correction: (or None) Either ``bh`` for :py:func:`bh_correction` or ``bonferroni`` to correct for multiple testing
+		:param int workers: (or None) Number of processes used by :py:func:`permutation_test`
+		:param int seed: (or None) Seed for the permutations
+		:returns: :attr:`graphSet.Dp`
+
+		.. attribute:: graphSet.Dp
+
+			Dictionary with ctype as the key and an array of shape (alpha, theta) containing p values as the item
+		'''
+
+		self.LsUn = np.unique(self.Ls)
+		self.LcUn = np.unique(self.Lc)
+
+		#P values are only recalculated if the data or parameters changed
+		pkey = json.dumps([test,nperm,correction,seed,
+			[[c,s,self.Dc[c][s].key] for c in self.LcUn for s in self.LsUn]])
+		if pkey == self.pkey:
+			return(self.Dp)
+
+		self.Dp = {}
+		for c in self.LcUn:
+			dc = self.Dc[c]
+			arr1,arr2 = dc[self.LsUn[0]].arr_masked,dc[self.LsUn[1]].arr_masked
+
+			if test == 'permutation':
+				diff,parr = permutation_test(arr1,arr2,nperm=nperm,seed=seed,workers=workers)
+			else:
+				parr = stats.ttest_ind(arr1,arr2,axis=2,nan_policy='omit')[1]
+				parr = np.asarray(parr,dtype=float)
+
+			if correction == 'bh':
+				parr = bh_correction(parr)
+			elif correction == 'bonferroni':
+				parr = np.minimum(parr*np.sum(~np.isnan(parr)),1)
+
+			self.Dp[c] = parr
+
+		self.pkey = pkey
+		return(self.Dp)
+
+	def check_summary_params(self,test=None,nperm=None,correction=None):
+		'''
+		Check that the p values read by :py:func:`read_graph_summary` were calculated with the requested parameters
+
+		:param str test: (or None) Requested statistical test
+		:param int nperm: (or None) Requested number of permutations, only compared for permutation tests
+		:param str correction: (or None) Requested multiple testing correction
+		'''
+
+		requested = {'test':test,'nperm':nperm,'correction':correction}
+		if all([v == None for v in requested.values()]):
+			return
+
+		if self.pkey == None:
+			raise ValueError('The summary does not contain p values, which cannot be recalculated without landmark data')
+
+		saved = dict(zip(['test','nperm','correction'],json.loads(self.pkey)[:3]))
+		if saved['test'] != 'permutation':
+			requested['nperm'] = None
+
+		for k,v in requested.items():
+			if (v != None) and (v != saved[k]):
+				raise ValueError('Requested '+k+'='+str(v)+' but the summary p values were calculated with '+k+'='+str(saved[k]))
+
+	def save_summary(self,filepath):
+		'''
+		Save the average, sem and p value arrays needed by :func:`graphSet.make_figure` into an hdf5 file that can be read with :py:func:`read_graph_summary`
+
+		P values are saved if they have been calculated by :func:`graphSet.calc_pvalues`
+
+		:param str filepath: Complete filepath to output file, which should end in .hdf5
+		'''
+
+		f = h5py.File(filepath,'w')
+		f.attrs['tpairs'] = np.asarray(self.tpairs,dtype=float)
+		f.attrs['xarr'] = np.asarray(self.xarr,dtype=float)
+		f.attrs['tarr'] = np.asarray(self.tarr,dtype=float)
+		f.attrs['Ls'] = json.dumps([str(x) for x in self.Ls])
+		f.attrs['Lc'] = json.dumps([str(x) for x in self.Lc])
+		if self.pkey != None:
+			f.attrs['pkey'] = self.pkey
+
+		for c in self.Dc.keys():
+			for st,gD in self.Dc[c].items():
+				g = f.create_group('data/'+str(c)+'/'+str(st))
+				g.create_dataset('avg',data=gD.avg)
+				g.create_dataset('sem',data=np.asarray(gD.sem))
+				g.attrs['color'] = gD.c
+				g.attrs['key'] = gD.key
+
+		for c,parr in self.Dp.items():
+			f.create_dataset('pvalues/'+str(c),data=parr)
+
+		f.close()
+
+	def make_figure(self,a,mt_key,figsize=(10,8),P=True,pthresh=None,cbar=False,test=None,nperm=None,correction=None,workers=1):
 		'''
 		Creates a figure showing four theta slices and as many columns as ctypes
 
 		.. todo:: P value scatter plot is broken
 
-		.. todo:: Control p val for multiple testing
-
 		:param float a: Alpha value for fill_between ribbons
 		:param str mt_key: String indicating the data type of the experimental group
 		:param tuple figsize: Tuple specifying the height and width of the figure
 		:param bool P: True if pvalue should be plotted
-		:param float pthresh: None or float value for p-value threshold
+		:param float pthresh: None or float value for the threshold applied to the p values in :attr:`graphSet.Dp`, which are corrected according to `correction`
 		:param bool cbar: Default false, if true plots colorbar for p values
+		:param str test: (or None) Statistical test passed to :func:`graphSet.calc_pvalues`, by default ``ttest``
+		:param int nperm: (or None) Number of permutations passed to :func:`graphSet.calc_pvalues`, by default 10000
+		:param str correction: (or None) Multiple testing correction passed to :func:`graphSet.calc_pvalues`
+		:param int workers: (or None) Number of processes passed to :func:`graphSet.calc_pvalues`
+
+		If the graphSet was read by :py:func:`read_graph_summary`, the saved p values are plotted and a ValueError is raised if `test`, `nperm` or `correction` is given and differs from the parameters used for the saved p values
 
 		.. attribute:: graphSet.fig
 
@@ -1399,15 +2936,27 @@ class graphSet:
 
 		self.fig,self.axr = plt.subplots(4,len(self.LsUn),figsize=figsize,sharey=True)
 
+		if self.summary == False:
+			if test == None:
+				test = 'ttest'
+			if nperm == None:
+				nperm = 10000
+			self.calc_pvalues(test=test,nperm=nperm,correction=correction,workers=workers)
+		else:
+			self.check_summary_params(test,nperm,correction)
+
 		for j,c in enumerate(self.LcUn):
 			dc = self.Dc[c]
-			parr = stats.ttest_ind(dc[self.LsUn[0]].arr_masked,dc[self.LsUn[1]].arr_masked,axis=2,nan_policy='omit')[1]
+			if c in self.Dp:
+				parr = self.Dp[c].copy()
+			else:
+				parr = np.full((len(self.xarr),len(self.tarr)),np.nan)
 
+			#Threshold the p values after the correction selected in calc_pvalues
 			if pthresh != None:
-				bhthresh = pthresh/(len(self.xarr)*len(self.tarr))
-				parr[parr<pthresh] = 0
-				parr[parr>pthresh] = 1
-				print(bhthresh)
+				sig = parr < pthresh
+				parr[parr >= pthresh] = 1
+				parr[sig] = 0
 
 			for i,p in enumerate(self.tpairs):
 				for s in self.LsUn:
@@ -1451,11 +3000,14 @@ class graphData:
 		'''
 		self.c = color
 		self.rawdf = rawdf
+		self.key = None
 
 	def prepare_data(self,xarr,tarr,dtype):
 		'''
 		Convert to array and calculate average and sem
 
+		The arrays are only recalculated if :attr:`graphData.rawdf` or the landmark configuration changed since the last call
+
 		:param arr xarr: List of min and max borders of the alpha bins
 		:param arr tarr: List of min and max borders of the theta bins
 		:param str dtype: Either ``pts`` or ``r`` specifies which data to save to array
@@ -1471,7 +3023,15 @@ class graphData:
 		.. attribute:: graphData.sem
 
 			Standard error of the mean for :attr:`graphData.arr`
+
+		.. attribute:: graphData.key
+
+			Hash of the landmark data and configuration calculated by :py:func:`landmark_key`
 		'''
+		key = landmark_key(self.rawdf,xarr,tarr,dtype)
+		if key == self.key:
+			return
+
 		self.arr,L = convert_to_arr(xarr,tarr,dtype,self.rawdf)
 
 		nanmask = np.nanmean(self.arr,axis=2)[:,:,np.newaxis] + np.ones((1,1,self.arr.shape[-1]))
@@ -1482,6 +3042,143 @@ class graphData:
 
 		self.avg = np.nanmean(self.arr_masked,axis=2)
 		self.sem = stats.sem(self.arr_masked,axis=2,nan_policy='omit')
+		self.key = key
+
+def read_graph_summary(filepath):
+	'''
+	Read a summary saved by :func:`graphSet.save_summary` into a :class:`graphSet` that can be plotted without the landmark dataframes
+
+	:param str filepath: Complete filepath to file
+	:returns: :class:`graphSet` containing :class:`graphData` objects with avg, sem and color and the saved p values
+	'''
+
+	f = h5py.File(filepath,'r')
+	gS = graphSet(f.attrs['tpairs'],f.attrs['xarr'],f.attrs['tarr'])
+	gS.Ls = json.loads(f.attrs['Ls'])
+	gS.Lc = json.loads(f.attrs['Lc'])
+
+	for c in f['data'].keys():
+		for st in f['data'][c].keys():
+			g = f['data'][c][st]
+			gD = graphData(None,g.attrs['color'])
+			gD.avg,gD.sem = g['avg'][:],g['sem'][:]
+			gD.key = g.attrs['key']
+			gS.add_to_dict(gS.Ds,st,c,gD)
+			gS.add_to_dict(gS.Dc,c,st,gD)
+
+	if 'pvalues' in f:
+		gS.Dp = {c:f['pvalues'][c][:] for c in f['pvalues'].keys()}
+		gS.pkey = f.attrs.get('pkey')
+	gS.summary = True
+
+	f.close()
+	return(gS)
+
+def fit_fold_pca(X,train,test,threshold=0.9999):
+	'''
+	Fill missing values, scale and transform the samples of one cross validation fold with a PCA that is fit only on the training samples
+
+	The number of components is chosen as in :func:`treeClassifier.apply_pca`
+
+	:param np.array X: Array of shape (samples, landmarks) that may contain nan values
+	:param np.array train: Indices of training samples
+	:param np.array test: Indices of test samples
+	:param float threshold: (or None) Fraction of the variance that the components should explain
+	:returns: Transformed training and test arrays
+	'''
+
+	#Missing values are filled with the training mean of each landmark
+	with np.errstate(invalid='ignore'):
+		mean = np.nanmean(X[train],axis=0)
+	mean[np.isnan(mean)] = 0
+	Xtrain = np.where(np.isnan(X[train]),mean,X[train])
+	Xtest = np.where(np.isnan(X[test]),mean,X[test])
+
+	sc = StandardScaler().fit(Xtrain)
+	Xtrain,Xtest = sc.transform(Xtrain),sc.transform(Xtest)
+
+	pca = PCA(svd_solver='full').fit(Xtrain)
+	evar = np.cumsum(pca.explained_variance_ratio_)
+	n = min(np.searchsorted(evar,threshold)+1,len(evar))
+
+	pca = PCA(n_components=n,svd_solver='full').fit(Xtrain)
+	return(pca.transform(Xtrain),pca.transform(Xtest))
+
+def fit_fold_classifier(X,Y,train,test,params,random_state=0,n_repeats=10,n_jobs=None,fold=0,threshold=None):
+	'''
+	Fit a random forest classifier on one cross validation fold and score it on the test samples
+
+	If `threshold` is given, `X` contains landmarks that are reduced by :py:func:`fit_fold_pca` using only the training samples. Otherwise `X` is used as is, e.g. :attr:`treeClassifier.Xtr`
+
+	:param np.array X: Array of shape (samples, features)
+	:param np.array Y: Array of sample types
+	:param np.array train: Indices of training samples
+	:param np.array test: Indices of test samples
+	:param dict params: Parameters passed to `sklearn.ensemble.RandomForestClassifier`
+	:param int random_state: (or None) Seed for the trees and permutations
+	:param int n_repeats: (or None) Number of repeats of the permutation importance, no permutation importance is calculated if 0
+	:param int n_jobs: (or None) Number of trees fit in parallel
+	:param int fold: (or None) Index of the fold saved in the results
+	:param float threshold: (or None) Explained variance threshold passed to :py:func:`fit_fold_pca`
+	:returns: Dictionary containing parameters, fold, pca, n_components, score, fit_time, score_time and the importance of each feature
+	'''
+
+	D = dict(params)
+	D['fold'] = fold
+
+	tic = time.time()
+	if threshold != None:
+		Xtrain,Xtest = fit_fold_pca(X,train,test,threshold)
+		D['pca'] = 'fold'
+	else:
+		Xtrain,Xtest = X[train],X[test]
+		D['pca'] = 'global'
+	D['n_components'] = Xtrain.shape[1]
+
+	rf = RandomForestClassifier(random_state=random_state,n_jobs=n_jobs,**params)
+	rf.fit(Xtrain,Y[train])
+	D['fit_time'] = time.time()-tic
+
+	tic = time.time()
+	D['score'] = rf.score(Xtest,Y[test])
+	D['score_time'] = time.time()-tic
+
+	for i,v in enumerate(rf.feature_importances_):
+		D['imp_'+str(i)] = v
+
+	if n_repeats > 0:
+		perm = permutation_importance(rf,Xtest,Y[test],n_repeats=n_repeats,random_state=random_state,n_jobs=n_jobs)
+		for i,v in enumerate(perm.importances_mean):
+			D['perm_'+str(i)] = v
+
+	return(D)
+
+def evaluate_landmark_sets(Ddf,path=None,**kwargs):
+	'''
+	Screen several landmark datasets, e.g. from an :class:`anumSelect` sweep, with :func:`treeClassifier.evaluate_classifier`
+
+	:param dict Ddf: Dictionary of landmark dataframes, each containing an stype column
+	:param str path: Optionally include a filepath to save the combined results as a csv file
+	:param kwargs: Keyword arguments passed to :func:`treeClassifier.evaluate_classifier`
+	:returns: pd.DataFrame of :attr:`treeClassifier.cv_results` for all datasets with the dictionary key in the column ``key``
+	'''
+
+	L = []
+	for k in Ddf.keys():
+		tc = treeClassifier(Ddf[k])
+		if kwargs.get('refit_pca',True) == False:
+			tc.apply_pca()
+		tc.evaluate_classifier(**kwargs)
+
+		res = tc.cv_results
+		res.insert(0,'key',k)
+		L.append(res)
+
+	out = pd.concat(L,ignore_index=True)
+	if path != None:
+		out.to_csv(path,index=False)
+
+	return(out)
 
 class treeClassifier:
 
@@ -1506,10 +3203,15 @@ class treeClassifier:
 		self.Xnan = self.Xraw.dropna(axis=1,how='all').fillna(self.Xraw.mean())
 		self.Xsc = scale(self.Xnan)
 
-	def apply_pca(self,plot=False):
+	def apply_pca(self,plot=False,threshold=0.9999,svd_solver='auto',max_components=500):
 		'''Find optimal number of components and transform data
 
+		The data is decomposed once and the number of components is the first that reaches `threshold` in the cumulative explained variance ratio
+
 		:param bool plot: If true, a plot showing the pca parameter sweep will be generated
+		:param float threshold: (or None) Fraction of the variance that the components should explain
+		:param str svd_solver: (or None) ``full``, ``randomized`` or ``auto``, which uses a full decomposition unless both dimensions of the data are more than four times larger than `max_components`
+		:param int max_components: (or None) Number of components calculated by the randomized solver. If these do not reach `threshold`, a full decomposition is used instead
 
 		.. attribute:: treeClassifier.Xtr
 
@@ -1522,38 +3224,70 @@ class treeClassifier:
 		.. attribute:: treeClassifier.comp
 
 			pd.DataFrame containing :attr:`treeClassifier.n` rows with the weight of each landmark in the column
+
+		.. attribute:: treeClassifier.pca
+
+			Fitted sklearn.decomposition.PCA truncated to :attr:`treeClassifier.n` components
+
+		.. attribute:: treeClassifier.evar
+
+			Cumulative explained variance ratio of each number of components
 		'''
 
-		#Parameter sweep for optimum component number
-		evar = []
-		for i in range(1,100):
-			tpca = PCA(n_components=i)
-			tpca.fit(self.Xsc)
-			evar.append(tpca.explained_variance_ratio_.sum())
+		if svd_solver == 'auto':
+			if min(self.Xsc.shape) > 4*max_components:
+				svd_solver = 'randomized'
+			else:
+				svd_solver = 'full'
+
+		if svd_solver == 'randomized':
+			pca = PCA(n_components=max_components,svd_solver='randomized',random_state=0)
+			pca.fit(self.Xsc)
+			if np.sum(pca.explained_variance_ratio_) < threshold:
+				svd_solver = 'full'
+
+		if svd_solver == 'full':
+			pca = PCA(svd_solver='full')
+			pca.fit(self.Xsc)
 
 		#Find first n that is close to equaling 1
-		self.n = np.nonzero(np.array(evar)>=0.9999)[0][0] +1 #Accounts for list starting at 1
+		self.evar = np.cumsum(pca.explained_variance_ratio_)
+		self.n = min(np.searchsorted(self.evar,threshold)+1,len(self.evar))
 		print(str(self.n),'components accounts for 100 percent of the variability in the data')
 
-		pca = PCA(n_components=self.n)
-		pca.fit(self.Xsc)
+		#Keep the first n components, which are identical to fitting PCA(n_components=n)
+		pca.components_ = pca.components_[:self.n]
+		pca.explained_variance_ = pca.explained_variance_[:self.n]
+		pca.explained_variance_ratio_ = pca.explained_variance_ratio_[:self.n]
+		pca.singular_values_ = pca.singular_values_[:self.n]
+		pca.n_components_ = self.n
+		pca.n_components = self.n
+		self.pca = pca
+
 		self.Xtr = pca.transform(self.Xsc)
 		self.comp = pd.DataFrame(pca.components_,columns=self.Xnan.columns)
 
+		#Component arrays need to be recalculated from the new components
+		for attr in ['cParr','cRarr']:
+			if hasattr(self,attr):
+				delattr(self,attr)
+
 		if plot == True:
 			fig,ax = plt.subplots()
-			ax.plot(range(1,200),np.array(evar)*100)
+			ax.plot(np.arange(1,len(self.evar)+1),self.evar*100)
 			ax.set_ylabel('Explained Variance (%)')
 			ax.set_xlabel('Number of Components')
-			ax.axvline(self.n,c='r',label='N_components = '+str(n))
+			ax.axvline(self.n,c='r',label='N_components = '+str(self.n))
 			ax.legend()
 
-	def fit_classifier(self,max_features='sqrt',oob_score=True,n_estimators=500):
+	def fit_classifier(self,max_features='sqrt',oob_score=True,n_estimators=500,n_jobs=None,random_state=None):
 		'''Fit a random forest classifer to the transformed data to the trained data
 
 		:param str max_features: Default=``'sqrt'``. See `sklearn.ensemble.RandomForestClassifier`_ for more info.
 		:param bool oob_score: Default=``True``. See `sklearn.ensemble.RandomForestClassifier`_ for more info.
 		:param int n_estimators: Default=``500``. See `sklearn.ensemble.RandomForestClassifier`_ for more info.
+		:param int n_jobs: Default=``None``. Number of trees fit in parallel, see `sklearn.ensemble.RandomForestClassifier`_ for more info.
+		:param int random_state: Default=``None``. Seed for reproducible trees, see `sklearn.ensemble.RandomForestClassifier`_ for more info.
 
 		.. attribute:: treeClassifier.rftree
 
@@ -1567,7 +3301,9 @@ class treeClassifier:
 		'''
 		self.rftree = RandomForestClassifier(max_features=max_features,
 											oob_score=oob_score,
-											n_estimators=n_estimators)
+											n_estimators=n_estimators,
+											n_jobs=n_jobs,
+											random_state=random_state)
 		self.rftree.fit(self.Xtr,self.Y)
 
 		self.Importance = pd.DataFrame({'Importance':self.rftree.feature_importances_*100})
@@ -1575,6 +3311,61 @@ class treeClassifier:
 
 		print('Out of Bag score:',str(self.rftree.oob_score_))
 
+	def evaluate_classifier(self,n_estimators=[500],max_features=['sqrt'],n_splits=5,n_repeats=10,workers=1,n_jobs=None,random_state=0,path=None,refit_pca=True,threshold=0.9999):
+		'''Evaluate random forest classifiers with stratified k-fold cross validation for each combination of `n_estimators` and `max_features`
+
+		Each fold is fit by :py:func:`fit_fold_classifier`. Folds and trees are seeded by `random_state` so that results do not depend on `workers`
+
+		By default, missing values, scaling and PCA are fit on the training samples of each fold so that the test samples do not influence the components. Components therefore differ between folds, so the importance of a component index is only comparable within a fold. With `refit_pca=False`, :attr:`treeClassifier.Xtr` from :func:`treeClassifier.apply_pca` is used, which was fit on all samples including the test samples of each fold, so scores are optimistic
+
+		:param list n_estimators: Default=``[500]``. List of the number of trees to test
+		:param list max_features: Default=``['sqrt']``. List of max_features values to test
+		:param int n_splits: Default=``5``. Number of folds
+		:param int n_repeats: Default=``10``. Number of repeats of the permutation importance on each test fold, no permutation importance is calculated if 0
+		:param int workers: Default=``1``. Number of processes used to fit folds in parallel
+		:param int n_jobs: Default=``None``. Number of trees fit in parallel within each fold if `workers` is 1
+		:param int random_state: Default=``0``. Seed for the folds, trees and permutations
+		:param str path: Optionally include a filepath to save :attr:`treeClassifier.cv_results` as a csv file
+		:param bool refit_pca: Default=``True``. Fit the PCA within each fold instead of using :attr:`treeClassifier.Xtr`
+		:param float threshold: Default=``0.9999``. Fraction of the variance explained by the components of each fold if `refit_pca` is True
+
+		.. attribute:: treeClassifier.cv_results
+
+			pd.DataFrame with one row for each parameter combination and fold containing the test score, timings, whether the PCA was fit within the fold (``pca`` is ``fold``) or on all samples (``global``), the number of components and the impurity based importance (``imp_i``) and permutation importance (``perm_i``) of each component
+		'''
+
+		if refit_pca == True:
+			X = self.Xraw.dropna(axis=1,how='all').to_numpy(dtype=float)
+		else:
+			X = np.asarray(self.Xtr)
+			threshold = None
+		Y = np.asarray(self.Y)
+		skf = StratifiedKFold(n_splits=n_splits,shuffle=True,random_state=random_state)
+		folds = list(skf.split(X,Y))
+
+		if workers != 1:
+			n_jobs = 1
+
+		args = []
+		for n,m in it.product(n_estimators,max_features):
+			for i,(train,test) in enumerate(folds):
+				args.append((X,Y,train,test,{'n_estimators':n,'max_features':m},random_state,n_repeats,n_jobs,i,threshold))
+
+		if workers == 1:
+			results = [fit_fold_classifier(*arg) for arg in args]
+		else:
+			pool = mp.Pool(workers)
+			results = pool.starmap(fit_fold_classifier,args)
+			pool.close()
+			pool.join()
+
+		self.cv_results = pd.DataFrame(results)
+
+		print(self.cv_results.groupby(['n_estimators','max_features'])['score'].agg(['mean','std']))
+
+		if path != None:
+			self.cv_results.to_csv(path,index=False)
+
 	def print_top_components(self,index=None,thresh=None):
 		'''Prints a list of top components, which can be limited by index or threshold
 
@@ -1611,23 +3402,21 @@ class treeClassifier:
 			containing the r distance of the percentile per landmark
 		'''
 
-		dfc = reformat_to_cart(self.comp)
-		self.xarr = np.round(np.unique(dfc.x),2)
-		self.tarr = np.round(np.unique(dfc.t),2)
+		#Landmarks are located by the center of each bin
+		lmi = parse_landmarks(self.comp.columns)
+		x = np.round((lmi.amn.values+lmi.amx.values)/2,2)
+		t = np.round((lmi.tmn.values+lmi.tmx.values)/2,2)
+
+		rmask = (lmi.dtype=='r').values
+		self.xarr = np.round(np.unique(x[rmask]),2)
+		self.tarr = np.round(np.unique(t[rmask]),2)
 
 		self.cParr = np.zeros((len(self.xarr),len(self.tarr),self.n))
 		self.cRarr =  np.zeros((len(self.xarr),len(self.tarr),self.n))
 
-		for c in self.comp.columns:
-			if len(c.split('_')) == 6:
-				amn,amx,tmn,tmx,p,dtype = c.split('_')
-				x = np.mean([float(amn),float(amx)])
-				t = np.mean([float(tmn),float(tmx)])
-
-				if dtype=='r':
-					self.cRarr[np.where(self.xarr==np.round(x,2))[0],np.where(self.tarr==np.round(t,2))[0]] = self.comp[c]
-				elif dtype =='pts':
-					self.cParr[np.where(self.xarr==np.round(x,2))[0],np.where(self.tarr==np.round(t,2))[0]] = self.comp[c]
+		for arr,mask in [(self.cRarr,rmask),(self.cParr,(lmi.dtype=='pts').values)]:
+			cols,xi,ti = landmark_cells(lmi[mask],self.xarr,self.tarr,x[mask],t[mask])
+			arr[xi,ti] = self.comp[cols].to_numpy(dtype=float).T
 
 	def plot_top_components(self,index=None,thresh=None,path=None):
 		'''Plots the r heatmap and pts heatmap according to importance
@@ -1774,10 +3563,15 @@ def read_psi(filepath):
 	'''
 	Reads psi file at the given filepath and returns data in a pandas DataFrame
 
+	Files ending in .hdf5 are read with :py:func:`read_data_hdf5`
+
 	:param str filepath: Complete filepath to file
 	:returns: pd.Dataframe containing data
 	'''
 
+	if filepath.endswith('.hdf5'):
+		return(read_data_hdf5(filepath))
+
 	df = pd.read_csv(filepath,
 		sep=' ',
 		header=19)
@@ -1789,23 +3583,245 @@ def read_psi(filepath):
 
 	return(df)
 
-def read_psi_to_dict(directory,dtype):
+def read_psi_to_dict(directory,dtype,columns=None,float32=False,workers=1,lazy=False,maxmem=None):
 	'''
 	Read psis from directory into dictionary of dfs with filtering based on dtype
 
+	Binary files written by :py:func:`write_data_hdf5` are also read. If both a psi and an .hdf5 file exist for a sample, the .hdf5 file is used
+
 	:param str directory: Directory to get psis from
 	:param str dtype: Usually 'AT' or 'ZRF1'
+	:param list columns: (or None) Columns to keep, e.g. ``['ac','r','theta']`` for landmarks. Only these columns are read from .hdf5 files
+	:param bool float32: (or None) If True, convert data columns to float32
+	:param int workers: (or None) Number of processes used to read files, by default files are read one at a time
+	:param bool lazy: (or None) If True, return a :py:class:`lazyPsiDict` that reads each sample when it is first used
+	:param int maxmem: (or None) Maximum number of bytes held in memory by a :py:class:`lazyPsiDict`
 	:returns: Dictionary of pd.DataFrame
 	'''
 
-	dfs = {}
-	for f in tqdm.tqdm(os.listdir(directory)):
-		if (dtype in f)&('psi' in f):
-			df = read_psi(os.path.join(directory,f))
+	files = {}
+	for f in sorted(os.listdir(directory)):
+		if (dtype in f)&(('psi' in f)|f.endswith('.hdf5')):
 			num = re.findall(r'\d+',f.split('.')[0])[0]
-			dfs[num] = df
+			if (num not in files) or f.endswith('.hdf5'):
+				files[num] = os.path.join(directory,f)
+
+	if lazy == True:
+		return(lazyPsiDict(files,columns=columns,float32=float32,maxmem=maxmem))
+
+	keys = list(files.keys())
+	load = partial(read_psi_columns,columns=columns,float32=float32)
+
+	if workers == 1:
+		Ldf = [load(files[k]) for k in tqdm.tqdm(keys)]
+	else:
+		pool = mp.Pool(workers)
+		Ldf = list(tqdm.tqdm(pool.imap(load,[files[k] for k in keys]),total=len(keys)))
+		pool.close()
+		pool.join()
+
+	return(dict(zip(keys,Ldf)))
+
+def read_psi_columns(filepath,columns=None,float32=False):
+	'''
+	Read a psi or .hdf5 file with :py:func:`read_psi` keeping only selected columns
+
+	:param str filepath: Complete filepath to file
+	:param list columns: (or None) Columns to keep in addition to the point index ``i``, by default all columns are kept
+	:param bool float32: (or None) If True, convert data columns to float32
+	:returns: pd.Dataframe containing data
+	'''
+
+	if filepath.endswith('.hdf5'):
+		df = read_data_hdf5(filepath,columns=columns)
+	else:
+		df = read_psi(filepath)
+
+	#The point index is always returned, as by read_data_hdf5
+	if columns != None:
+		df = df[[c for c in df.columns if (c == 'i') or (c in columns)]]
+
+	if float32 == True:
+		df = df.astype({c:'float32' for c in df.columns if c != 'i'})
+
+	return(df)
+
+class lazyPsiDict(Mapping):
+	'''
+	Dictionary of samples that reads each file with :py:func:`read_psi_columns` when it is first accessed and keeps the most recently used samples in memory
+
+	:param dict files: Dictionary of filepaths with the sample number as the key
+	:param list columns: (or None) Columns to keep for each sample
+	:param bool float32: (or None) If True, convert data columns to float32
+	:param int maxmem: (or None) Maximum number of bytes of data held in memory. If None, samples are never removed
+
+	.. py:attribute:: lazyPsiDict.loaded
+
+		OrderedDict of loaded samples with the most recently used sample last
+
+	.. py:attribute:: lazyPsiDict.nbytes
+
+		Number of bytes currently held in :py:attr:`lazyPsiDict.loaded`
+	'''
+
+	def __init__(self,files,columns=None,float32=False,maxmem=None):
+
+		self.files = files
+		self.columns = columns
+		self.float32 = float32
+		self.maxmem = maxmem
+		self.loaded = OrderedDict()
+		self.nbytes = 0
+
+	def __getitem__(self,key):
+
+		if key in self.loaded:
+			self.loaded.move_to_end(key)
+			return(self.loaded[key])
+
+		df = read_psi_columns(self.files[key],columns=self.columns,float32=self.float32)
+		self.loaded[key] = df
+		self.nbytes += df.memory_usage(index=True).sum()
+
+		#Remove least recently used samples, but always keep the current sample
+		if self.maxmem != None:
+			while (self.nbytes > self.maxmem) and (len(self.loaded) > 1):
+				k,old = self.loaded.popitem(last=False)
+				self.nbytes -= old.memory_usage(index=True).sum()
+
+		return(df)
+
+	def __contains__(self,key):
+		#Checking for a key should not read the sample from disk
+		return(key in self.files)
+
+	def __iter__(self):
+		return(iter(self.files))
+
+	def __len__(self):
+		return(len(self.files))
 
-	return(dfs)
+def write_data_hdf5(filepath,df,dtype='float32',compression='gzip',columns=None):
+	'''
+	Writes data to a binary columnar hdf5 file as an alternative to :py:func:`write_data`
+
+	Each of the columns x,y,z,ac,r,theta that is present in `df` is saved as a separate compressed dataset so that columns can be read independently. The index of `df` is saved as ``i``.
+
+	:param str filepath: Complete filepath to output file, which should end in .hdf5
+	:param pd.DataFrame df: dataframe containing columns x,y,z and optionally ac,r,theta
+	:param str dtype: (or None) Data type used to store each column. If None, the data type of each column is kept
+	:param str compression: (or None) Compression filter passed to h5py
+	:param list columns: (or None) Columns of `df` to save, e.g. to include the value column of :py:attr:`brain.df_thresh`. By default x,y,z,ac,r,theta are saved.
+	'''
+
+	if columns == None:
+		columns = [c for c in ['x','y','z','ac','r','theta'] if c in df.columns]
+
+	f = h5py.File(filepath,'w')
+	f.create_dataset('i',data=np.asarray(df.index),compression=compression,shuffle=True)
+	for c in columns:
+		data = df[c].values
+		if dtype != None:
+			data = data.astype(dtype)
+		f.create_dataset(c,data=data,compression=compression,shuffle=True)
+	f.attrs['columns'] = ','.join(columns)
+	f.close()
+
+	print('Write to',filepath,'complete')
+
+def read_data_hdf5(filepath,columns=None):
+	'''
+	Reads a file written by :py:func:`write_data_hdf5` into a pandas DataFrame with the same columns as :py:func:`read_psi`
+
+	:param str filepath: Complete filepath to file
+	:param list columns: (or None) Subset of columns to read, by default all columns are read
+	:returns: pd.Dataframe containing data
+	'''
+
+	f = h5py.File(filepath,'r')
+	if columns == None:
+		columns = f.attrs['columns'].split(',')
+
+	D = {'i':f['i'][:]}
+	for c in ['x','y','z','ac','theta','r']:
+		if c in columns:
+			D[c] = f[c][:]
+	#Any other saved columns follow in the order they were written
+	for c in f.attrs['columns'].split(','):
+		if (c in columns) and (c not in D):
+			D[c] = f[c][:]
+	f.close()
+
+	return(pd.DataFrame(D))
+
+def read_psi_points(filepath):
+	'''
+	Reads every point in a psi file written by :py:func:`write_data`
+
+	Unlike :py:func:`read_psi`, the number of header lines is counted so that the first point is not used as a header row
+
+	:param str filepath: Complete filepath to file
+	:returns: pd.Dataframe with the index of the file and columns x,y,z and optionally ac,theta,r
+	'''
+
+	f = open(filepath,'r')
+
+	#Skip comments, the line with the number of points and the three line translation matrix
+	nlines = 0
+	for line in f:
+		if (line.strip() == '') or line.startswith('#'):
+			continue
+		nlines += 1
+		if nlines == 4:
+			break
+
+	df = pd.read_csv(f,sep=' ',header=None,index_col=0)
+	f.close()
+
+	if len(df.columns) == 3:
+		df.columns = ['x','y','z']
+	else:
+		df.columns = ['x','y','z','ac','theta','r']
+
+	return(df)
+
+def convert_psi_dir(directory,outdir=None,dtype='float32',remove=False):
+	'''
+	Convert every psi file in a directory to the binary format of :py:func:`write_data_hdf5`
+
+	Each converted file is read back with :py:func:`read_data_hdf5` and must contain the same points and the same values of every column, at `dtype`, as the psi file before the psi file is removed
+
+	:param str directory: Directory containing psi files
+	:param str outdir: (or None) Directory for the converted files, defaults to `directory`
+	:param str dtype: (or None) Data type used to store each column
+	:param bool remove: (or None) If True, delete each psi file after it has been converted
+	:returns: List of converted filepaths
+	'''
+
+	if outdir == None:
+		outdir = directory
+
+	Lout = []
+	for f in tqdm.tqdm(sorted(glob.glob(os.path.join(directory,'*.psi')))):
+		out = os.path.join(outdir,os.path.splitext(os.path.basename(f))[0]+'.hdf5')
+		df = read_psi_points(f)
+		write_data_hdf5(out,df,dtype=dtype)
+
+		check = read_data_hdf5(out)
+		if (len(check) != len(df)) or (not np.array_equal(check['i'].values,np.asarray(df.index))):
+			raise ValueError('Converted file '+out+' does not match '+f)
+		for c in [c for c in df.columns if c in ['x','y','z','ac','r','theta']]:
+			expected = df[c].values
+			if dtype != None:
+				expected = expected.astype(dtype)
+			if (c not in check.columns) or (not np.allclose(check[c].values,expected,equal_nan=True)):
+				raise ValueError('Column '+c+' of converted file '+out+' does not match '+f)
+		Lout.append(out)
+
+		if remove == True:
+			os.remove(f)
+
+	return(Lout)
 
 ###### Stand alone functions
 
@@ -1864,57 +3880,139 @@ def calculate_models(Ldf):
 
 	return(modeldf)
 
-def generate_kde(data,var,x,absv=False):
+def kde_bandwidth(y,bw_method='scott'):
+	'''
+	Calculate the kernel standard deviation that `scipy.stats.gaussian_kde` uses for 1D data
+
+	:param array y: 1D array of data
+	:param bw_method: (or None) ``scott``, ``silverman`` or a scalar factor as in `scipy.stats.gaussian_kde`
+	:returns: Standard deviation of the gaussian kernel
+	'''
+
+	n = len(y)
+	if bw_method == 'scott':
+		factor = n**(-1/5)
+	elif bw_method == 'silverman':
+		factor = (n*3/4)**(-1/5)
+	else:
+		factor = float(bw_method)
+
+	return(np.std(y,ddof=1)*factor)
+
+def binned_kde(Ly,x,bw_method='scott',oversample=20,maxbins=2**20):
+	'''
+	Evaluate a gaussian KDE for several 1D datasets on the same points using linear binning onto a shared grid and FFT convolution
+
+	Kernel bandwidths follow `scipy.stats.gaussian_kde` for each dataset, see :py:func:`kde_bandwidth`. All data is used without subsampling. The grid only covers `x` and a margin of six kernel widths, so points outside of it, which do not contribute to the KDE at `x`, are dropped but still counted for normalization
+
+	:param list Ly: List of 1D arrays of data
+	:param array x: Array of datapoints to evaluate the KDEs on
+	:param bw_method: (or None) Bandwidth rule passed to :py:func:`kde_bandwidth`
+	:param int oversample: (or None) Number of grid points per standard deviation of the narrowest kernel
+	:param int maxbins: (or None) Maximum number of grid points
+	:returns: Array of shape (datasets, len(x)) containing the KDEs, with nan for datasets with fewer than two points or no variance
+	'''
+
+	x = np.asarray(x,dtype=float)
+	Ly = [np.asarray(y,dtype=float) for y in Ly]
+	Ly = [y[np.isfinite(y)] for y in Ly]
+
+	out = np.full((len(Ly),len(x)),np.nan)
+	sigma = np.array([kde_bandwidth(y,bw_method) if len(y) > 1 else np.nan for y in Ly])
+	valid = np.flatnonzero(sigma > 0)
+	if len(valid) == 0:
+		return(out)
+
+	#Grid covering x with a margin so that kernels do not wrap around in the FFT
+	smax,smin = np.max(sigma[valid]),np.min(sigma[valid])
+	lo = np.min(x) - 6*smax
+	hi = np.max(x) + 6*smax
+	nbins = int(min(np.ceil((hi-lo)*oversample/smin),maxbins))
+	nbins = int(2**np.ceil(np.log2(max(nbins,2))))
+	dx = (hi-lo)/(nbins-1)
+
+	#Linear binning of every dataset into one array of counts
+	counts = np.zeros((len(valid),nbins))
+	for i,v in enumerate(valid):
+		pos = (Ly[v]-lo)/dx
+		pos = pos[(pos>=0)&(pos<=nbins-1)]
+		b = np.minimum(np.floor(pos).astype(int),nbins-2)
+		w = pos-b
+		counts[i] = np.bincount(b,weights=1-w,minlength=nbins) + np.bincount(b+1,weights=w,minlength=nbins)
+
+	#Convolve with a gaussian of each bandwidth in the frequency domain
+	freq = np.fft.rfftfreq(nbins,d=dx)
+	kernel = np.exp(-0.5*(2*np.pi*freq[np.newaxis,:]*sigma[valid][:,np.newaxis])**2)
+	dens = np.fft.irfft(np.fft.rfft(counts,axis=1)*kernel,n=nbins,axis=1)
+	dens = np.maximum(dens,0)/(np.array([len(Ly[v]) for v in valid])[:,np.newaxis]*dx)
+
+	#Linear interpolation from the grid onto x
+	pos = (x-lo)/dx
+	b = np.clip(np.floor(pos).astype(int),0,nbins-2)
+	w = pos-b
+	out[valid] = dens[:,b]*(1-w) + dens[:,b+1]*w
+	return(out)
+
+def generate_kde(data,var,x,absv=False,method='fft',frac=None,bw_method='scott'):
 	'''
 	Generate list of KDEs from either dictionary or list of data
 
 	:param data: pd.DataFrames to convert
-	:type: dict or list
+	:type: dict, :py:class:`lazyPsiDict` or list
 	:param str var: Name of column to select from df
 	:param array x: Array of datapoints to evaluate KDE on
 	:param bool absv: (or None) Set to True to use absolute value of selected data for KDE calculation
+	:param str method: (or None) ``fft`` to evaluate all KDEs at once with :py:func:`binned_kde` or ``gaussian_kde`` to evaluate each KDE with `scipy.stats.gaussian_kde`
+	:param float frac: (or None) Fraction of each dataset to randomly sample, by default all data is used with ``fft`` and 0.1 with ``gaussian_kde``
+	:param bw_method: (or None) Bandwidth rule, see :py:func:`kde_bandwidth`
 	:returns: List of KDE arrays
 	'''
 
-	L = []
+	if frac == None and method == 'gaussian_kde':
+		frac = 0.1
 
 	#Dictionary workflow
-	if type(data) ==  type({}):
-		for key in data.keys():
-			if absv == False:
-				y = data[key][var].sample(frac=0.1)
-			elif absv == True:
-				y = np.abs(data[key][var].sample(frac=0.1))
-			kde = scipy.stats.gaussian_kde(y).evaluate(x)
-			L.append(kde)
+	if isinstance(data,Mapping):
+		Ldf = (data[key] for key in data.keys())
 	#List workflow
 	elif type(data) == type([]):
-		for df in data:
-			if absv == False:
-				y = df[var].sample(frac=0.1)
-			elif absv == True:
-				y = np.abs(df[var].sample(frac=0.1))
-			kde = scipy.stats.gaussian_kde(y).evaluate(x)
-			L.append(kde)
+		Ldf = data
+	else:
+		return([])
+
+	Ly = []
+	for df in Ldf:
+		y = df[var]
+		if frac != None:
+			y = y.sample(frac=frac)
+		if absv == True:
+			y = np.abs(y)
+		Ly.append(np.asarray(y))
+
+	if len(Ly) == 0:
+		return([])
 
-	return(L)
+	if method == 'gaussian_kde':
+		return([scipy.stats.gaussian_kde(y,bw_method=bw_method).evaluate(x) for y in Ly])
+	else:
+		return(list(binned_kde(Ly,x,bw_method=bw_method)))
 
 def calculate_area_error(pdf,Lkde,x):
 	'''
 	Calculate area between PDF and each kde in Lkde
 
 	:param array pdf: Array of probability distribution function that is the same shape as kdes in Lkde
-	:param list Lkde: List of arrays of Kdes
+	:param list Lkde: List of arrays of Kdes or 2D array with one kde in each row
 	:param array x: Array of datapoints used to generate pdf and kdes
 	:returns: List of error values for each kde in Lkde
 	'''
 
-	L = []
+	if len(Lkde) == 0:
+		return([])
 
-	for kde in Lkde:
-		L.append(simps(np.abs(pdf-kde),x))
+	err = simps(np.abs(np.asarray(pdf)[np.newaxis,:]-np.asarray(Lkde)),x=x,axis=1)
 
-	return(L)
+	return(list(err))
 
 def rescale_variable(Ddfs,var,newvar):
 	'''
@@ -22,27 +22,53 @@ def read_h5prob_to_dict(fdir):
 
     return(D)
 
-def preprocess(fpath,p,stop=None,pca=None,mm=None,vertex=None):
+def preprocess(fpath,p,stop=None,pca=None,mm=None,vertex=None,cache=True):
     '''
     Generate brain object and process until stop is triggered
 
+    If `cache` is True, results for each stage are reused from :py:data:`deltascope.stage_cache` when the same file has already been processed with the same parameters
+
     :param str stop: 'df_thresh' 'median' 'df_align'
+    :param bool cache: (or None) Set to False to recalculate every stage
     :return: Cranium brain object
     '''
 
     b = cranium.brain()
-    b.read_data(fpath)
-    b.preprocess_data(p['gthresh'],p['scale'],p['microns'])
+    if cache == True:
+        b.preprocess_data_cached(fpath,p['gthresh'],p['scale'],p['microns'])
+    else:
+        b.read_data(fpath)
+        b.preprocess_data(p['gthresh'],p['scale'],p['microns'])
     if stop == 'df_thresh':
         return(b)
 
+    #Only an alignment that is calculated from this sample can be reused
+    align_key = None
+    if (cache == True) & (pca is None) & (mm is None) & (vertex is None):
+        params = {k:p[k] for k in ['gthresh','scale','microns','mthresh','radius','comp_order','fit_dim','deg']}
+        align_key = cranium.stage_cache.make_key(fpath,'df_align',params)
+
     if pca == None:
-        b.calculate_pca_median(b.raw_data,p['mthresh'],p['radius'],p['microns'])
+        if cache == True:
+            b.calculate_pca_median_cached(fpath,p['mthresh'],p['radius'],p['microns'])
+        else:
+            b.calculate_pca_median(b.raw_data,p['mthresh'],p['radius'],p['microns'])
         pca = b.pcamed
     if stop == 'median':
         return(b)
 
-    b.pca_transform_3d(b.df_thresh,pca,p['comp_order'],p['fit_dim'],deg=p['deg'],mm=mm,vertex=vertex)
+    entry = None
+    if align_key != None:
+        entry = cranium.stage_cache.get(align_key)
+
+    if entry != None:
+        b.df_align = entry[0]['df_align']
+        b.mm = entry[1]['mm']
+        b.vertex = entry[1]['vertex']
+    else:
+        b.pca_transform_3d(b.df_thresh,pca,p['comp_order'],p['fit_dim'],deg=p['deg'],mm=mm,vertex=vertex)
+        if align_key != None:
+            cranium.stage_cache.put(align_key,{'df_align':b.df_align},{'mm':b.mm,'vertex':b.vertex})
     if (stop == 'df_align') | (stop == None):
         return(b)
 
@@ -320,11 +346,27 @@ def check_yz(df,Ldf,mm=None):
 
     return(out,Lout,ax,p)
 
-def make_graph(Ldf,Lim=[]):
+def density_df(ax,i,df,bins=256):
+    '''
+    Density image of df with projections in all 3 axes
+
+    :param plt.subplots ax: Subplot array with minimum dimension [2,3]
+    :param int i: Index of row that should be labeled
+    :param pd.DataFrame df: Dataframe containing 'x','y','z' columns
+    :param int bins: (or None) Number of bins in each dimension of the histogram
+    '''
+
+    cranium.hist_projection(ax[i,0],df.x,df.y,bins=bins)
+    cranium.hist_projection(ax[i,1],df.x,df.z,bins=bins)
+    cranium.hist_projection(ax[i,2],df.z,df.y,bins=bins)
+
+def make_graph(Ldf,Lim=[],npoints=20000,density=False):
     '''
     Plot the three projections of each dataframe in `Ldf`
 
     :param list Ldf: List of additionally dataframes that should be rotated based on the calculation from `df`
+    :param int npoints: (or None) Approximate number of points plotted for each dataframe, selected with :py:func:`deltascope.voxel_sample`. If None, a random 10% of points is plotted
+    :param bool density: (or None) If True, plot 2D histograms of all points instead of scatter plots
     :return: Array of subplots with minimum dimension of 2x3
     '''
 
@@ -332,7 +374,12 @@ def make_graph(Ldf,Lim=[]):
     fig,ax = plt.subplots(n,3,subplot_kw={'aspect':'equal','adjustable':'datalim'},figsize=(12,n*4))
 
     for i,d in enumerate(Ldf):
-        scatter_df(ax,i,d.sample(frac=0.1))
+        if density == True:
+            density_df(ax,i,d)
+        elif npoints == None:
+            scatter_df(ax,i,d.sample(frac=0.1))
+        else:
+            scatter_df(ax,i,cranium.voxel_sample(d,npoints))
         plot_lines(ax,i)
 
     for i,im in enumerate(Lim):
@@ -410,4 +457,202 @@ def ch_vertex(df,Ldf,pts=None):
     ax = make_graph([df1]+Ldf1)
     xrange = np.arange(df1.x.min(),df1.x.max())
     ax[0,1].plot(xrange,np.poly1d(mm)(xrange),c='m')
-    return(df1,Ldf1,mm,ax)
\ No newline at end of file
+    return(df1,Ldf1,mm,ax)
+######### Transform composition ###############
+
+class alignTransform:
+    '''
+    Accumulate manual alignment corrections as a single 4x4 affine matrix that is applied to every channel once with :py:func:`alignTransform.apply`
+
+    Points are treated as row vectors [x,y,z,1] so that a 3x3 rotation matrix A is applied in the same way as :py:func:`rotate`. Corrections are calculated from the primary channel, which is kept as a float32 array in the current frame and updated in place after each correction. Other channels are not changed until :py:func:`alignTransform.apply` is called.
+
+    :param pd.DataFrame df: Primary dataframe containing 'x','y','z' that is used to calculate corrections
+    :param list Ldf: (or None) List of additional dataframes that should be transformed with `df`
+
+    .. py:attribute:: alignTransform.M
+
+        4x4 affine matrix containing all corrections since the last call of :py:func:`alignTransform.apply`
+    '''
+
+    def __init__(self,df,Ldf=[]):
+
+        self.df = df
+        self.Ldf = Ldf
+        self.M = np.eye(4)
+        self.xyz = df[['x','y','z']].to_numpy(dtype='float32',copy=True)
+        self.buf = np.empty_like(self.xyz)
+        self.Lpreview = None
+
+    def frame(self):
+        '''
+        Primary channel in the current frame
+
+        :return: Dataframe containing 'x','y','z' that shares memory with :py:attr:`alignTransform.xyz`
+        '''
+
+        return(pd.DataFrame(self.xyz,columns=['x','y','z'],copy=False))
+
+    def compose(self,M):
+        '''
+        Add a 4x4 affine matrix to :py:attr:`alignTransform.M` and update the primary channel
+
+        :param np.array M: 4x4 affine matrix for row vectors
+        '''
+
+        self.M = np.dot(self.M,M)
+
+        np.matmul(self.xyz,M[:3,:3].astype('float32'),out=self.buf)
+        self.buf += M[3,:3].astype('float32')
+        self.xyz,self.buf = self.buf,self.xyz
+
+        if self.Lpreview != None:
+            for p in self.Lpreview:
+                p[:] = np.dot(p,M[:3,:3]) + M[3,:3]
+
+    def preview(self,npoints=20000):
+        '''
+        Spatially stratified subsample of each channel in the current frame for plotting with :py:func:`make_graph`
+
+        Points are selected once with :py:func:`deltascope.voxel_sample` and then transformed with every correction so that redrawing does not require sampling the full dataframes
+
+        :param int npoints: (or None) Approximate number of points for each channel
+        :return: List of dataframes for the primary and each additional dataframe
+        '''
+
+        if self.Lpreview == None:
+            self.Lpreview = []
+            for df in [self.df]+self.Ldf:
+                xyz = cranium.voxel_sample(df,npoints)[['x','y','z']].to_numpy(dtype='float32')
+                self.Lpreview.append(np.dot(xyz,self.M[:3,:3]).astype('float32') + self.M[3,:3].astype('float32'))
+
+        return([pd.DataFrame(p,columns=['x','y','z']) for p in self.Lpreview])
+
+    def rotate(self,A):
+        '''
+        Add a rotation to the transformation
+
+        :param np.array A: 3x3 array containing transformation matrix
+        '''
+
+        M = np.eye(4)
+        M[:3,:3] = A
+        self.compose(M)
+
+    def translate(self,t):
+        '''
+        Add a translation to the transformation
+
+        :param list t: Values added to x,y,z
+        '''
+
+        M = np.eye(4)
+        M[3,:3] = t
+        self.compose(M)
+
+    def zyswitch(self):
+        '''
+        Switch z and y axes, see :py:func:`zyswitch`
+        '''
+
+        self.rotate(np.array([[1,0,0],
+                    [0,0,1],
+                    [0,1,0]]))
+
+    def flip(self):
+        '''
+        Rotate by 180 degrees around the x axis, see :py:func:`flip`
+        '''
+
+        self.rotate(np.array([[1,0,0],
+                    [0,np.cos(np.pi),-np.sin(np.pi)],
+                    [0,np.sin(np.pi),np.cos(np.pi)]]))
+
+    def xrotate(self,d,pts=None):
+        '''
+        Define two anchor points and rotate so that the anchor points are level, see :py:func:`xrotate`
+
+        :param str d: Second dimension of the plane that needs to be rotated: 'z' or 'y'
+        :param pd.DataFrame pts: (or None) Two points in x and the dimension d
+        :return: `pts`
+        '''
+
+        if type(pts) == type(None):
+            pt1,pt2 = cranium.find_anchors(self.frame(),d)
+            pts = pd.DataFrame({'x':[pt1['x'],pt2['x']],d:[pt1[d],pt2[d]]})
+
+        mp,A = calc_rotation(pts,d)
+        self.rotate(A)
+
+        return(pts)
+
+    def vertex(self,pts=None):
+        '''
+        Calculate the vertex in the XZ plane and shift the vertex to the origin, see :py:func:`vertex`
+
+        :param pd.DataFrame pts: (or None) Points used to fit the parabola instead of the primary channel
+        :return: Coefficients of the parabola after translation
+        '''
+
+        df = self.frame()
+        if type(pts)!=type(None):
+            cf = np.polyfit(pts.x,pts.z,2)
+        else:
+            cf = np.polyfit(df.x,df.z,2)
+        x = -cf[1]/(2*cf[0])
+        z = np.poly1d(cf)(x)
+        y = np.mean(df.y)
+
+        self.translate([-x,-y,-z])
+
+        if type(pts)!=type(None):
+            cfout = np.polyfit(pts.x-x,pts.z-z,2)
+        else:
+            df = self.frame()
+            cfout = np.polyfit(df.x,df.z,2)
+
+        return(cfout)
+
+    def yzrotate(self,mm=None):
+        '''
+        Fit a line in YZ and rotate so the line is horizontal, see :py:func:`yzrotate`
+
+        :param np.array mm: (or None) Coefficients of the line
+        :return: 1d line function, range of z values for the line
+        '''
+
+        df = self.frame()
+        if mm is None:
+            mm = np.polyfit(df.z,df.y,1)
+        p = np.poly1d(mm)
+        xrange = np.arange(1.1*np.min(df.z), 1.1*np.max(df.z))
+        phi = -np.arctan(mm[0])
+
+        self.rotate(np.array([[1,0,0],
+                    [0,np.cos(phi),-np.sin(phi)],
+                    [0,np.sin(phi),np.cos(phi)]]))
+
+        return(p,xrange)
+
+    def apply(self,dtype='float32'):
+        '''
+        Apply :py:attr:`alignTransform.M` to the x,y,z columns of the primary dataframe and every dataframe in :py:attr:`alignTransform.Ldf` in place and reset the transformation
+
+        :param str dtype: (or None) Data type of the transformed columns
+        :return: Primary dataframe and list of additional dataframes
+        '''
+
+        R = self.M[:3,:3].astype(dtype)
+        t = self.M[3,:3].astype(dtype)
+
+        for df in [self.df]+self.Ldf:
+            xyz = np.dot(df[['x','y','z']].to_numpy(dtype=dtype),R)
+            xyz += t
+            df['x'] = xyz[:,0]
+            df['y'] = xyz[:,1]
+            df['z'] = xyz[:,2]
+
+        self.M = np.eye(4)
+        self.xyz = self.df[['x','y','z']].to_numpy(dtype='float32',copy=True)
+        self.buf = np.empty_like(self.xyz)
+
+        return(self.df,self.Ldf)
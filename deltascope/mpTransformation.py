@@ -7,6 +7,13 @@ from sys import argv
 from sys import exc_info
 import re
 import json
+import hashlib
+import pickle
+import shutil
+try:
+	import resource
+except ImportError:
+	resource = None
 
 class paramsClass:
 	'''
@@ -26,6 +33,7 @@ class paramsClass:
 		params = json.loads(config_data)
 
 		self.check_config(params,path)
+		self.param_hash = param_hash(params)
 
 	def add_outdir(self,path):
 		'''
@@ -166,6 +174,51 @@ class paramsClass:
 			print('Specification for 2D transformation must be boolean. Modify in',path)
 			raise
 
+		#Check optional coordinate transformation method
+		if D.get('transform','') in ['',None]:
+			self.transform = None
+		elif D['transform'] in ['minimize','vectorized']:
+			self.transform = D['transform']
+		else:
+			print('Transform input must be \'minimize\', \'vectorized\' or empty. Modify in',path)
+			raise
+
+		#Check optional downsampling factor for PCA
+		if D.get('pyramid',None) in ['',None]:
+			self.pyramid = None
+		elif type(D['pyramid']) == int:
+			self.pyramid = D['pyramid']
+		else:
+			print('Pyramid input must be an integer or empty. Modify in',path)
+			raise
+
+		#Check optional number of worker processes
+		if D.get('workers',None) in ['',None]:
+			self.workers = None
+		elif (type(D['workers']) == int) and (D['workers'] > 0):
+			self.workers = D['workers']
+		else:
+			print('Workers input must be a positive integer or empty. Modify in',path)
+			raise
+
+		#Check optional memory limit for each worker in MB
+		if D.get('maxmem',None) in ['',None]:
+			self.maxmem = None
+		elif (type(D['maxmem']) == int) and (D['maxmem'] > 0):
+			self.maxmem = D['maxmem']
+		else:
+			print('Maxmem input must be a positive integer or empty. Modify in',path)
+			raise
+
+		#Check optional output directory of a previous run
+		if D.get('resume',None) in ['',None]:
+			self.resume = None
+		elif os.path.isdir(D['resume']):
+			self.resume = D['resume']
+		else:
+			print('Resume directory path (resume) must specify an existing directory. Modify in',path)
+			raise
+
 		self.scale = [1,1,1]
 
 		print('All parameter inputs are correct')
@@ -194,52 +247,226 @@ def check_nums(P):
 
 	return(Lnums)
 
+def param_hash(D):
+	'''
+	Calculate a hash of the parameters that affect the results of processing
+
+	:param dict D: Dictionary containing parameters from the config file
+	:returns: Hexadecimal string
+	'''
+
+	params = {k:D[k] for k in D.keys() if k not in ['rootdir','resume','workers','maxmem']}
+	return(hashlib.md5(json.dumps(params,sort_keys=True).encode()).hexdigest())
+
+def sample_name(num,P):
+	'''
+	Name used for the manifest entry and checkpoints of a sample based on the structural channel file
+
+	:param int num: Index of the file in each channel directory
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:returns: String
+	'''
+
+	return(os.path.splitext(P.c1_files[num])[0])
+
+def input_files(num,P):
+	'''
+	List the input file for each channel of a sample
+
+	:param int num: Index of the file in each channel directory
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:returns: Dictionary of filepaths with the channel key as the key
+	'''
+
+	files = {P.c1_key:os.path.join(P.c1_dir,P.c1_files[num])}
+	for i in range(len(P.Lcdir)):
+		files[P.Lckey[i]] = os.path.join(P.Lcdir[i],P.Lcfiles[i][num])
+
+	return(files)
+
+def read_manifest(outdir):
+	'''
+	Read the manifest entries of all samples in an output directory
+
+	Each entry records the last stage that was saved (``thresh``, ``pca``, ``align`` or ``complete``), the parameter hash, the modification time of each input file, the processing time and the last error.
+
+	:param str outdir: Complete path to the output directory
+	:returns: Dictionary of entries with the sample name as the key
+	'''
+
+	D = {}
+	mdir = os.path.join(outdir,'manifest')
+	if os.path.isdir(mdir):
+		for f in sorted(os.listdir(mdir)):
+			if f.endswith('.json'):
+				D[f[:-5]] = json.load(open(os.path.join(mdir,f)))
+
+	return(D)
+
+def write_manifest_entry(P,name,entry):
+	'''
+	Save the manifest entry of one sample, replacing the previous entry in a single step so that an interrupted write does not corrupt it
+
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:param str name: Sample name from :func:`sample_name`
+	:param dict entry: Manifest entry
+	'''
+
+	mdir = os.path.join(P.outdir,'manifest')
+	os.makedirs(mdir,exist_ok=True)
+
+	path = os.path.join(mdir,name+'.json')
+	f = open(path+'.tmp','w')
+	json.dump(entry,f,indent=1)
+	f.close()
+	os.replace(path+'.tmp',path)
+
+def load_manifest_entry(num,P):
+	'''
+	Read the manifest entry of a sample and start a new entry if the parameters or input files have changed
+
+	:param int num: Index of the file in each channel directory
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:returns: Manifest entry
+	'''
+
+	name = sample_name(num,P)
+	mtimes = {k:os.path.getmtime(f) for k,f in input_files(num,P).items()}
+
+	path = os.path.join(P.outdir,'manifest',name+'.json')
+	if os.path.exists(path):
+		entry = json.load(open(path))
+		if (entry['params'] == P.param_hash) and (entry['mtimes'] == mtimes):
+			return(entry)
+
+	return({'stage':None,'params':P.param_hash,'mtimes':mtimes,'time':0,'error':None})
+
+def save_stage(e,P,name,entry,stage):
+	'''
+	Save intermediate data for a stage to the checkpoint directory of the sample and update its manifest entry
+
+	Every column of :py:attr:`brain.df_thresh` and :py:attr:`brain.df_align` is saved with its dtype so that a resumed sample matches an uninterrupted one
+
+	:param :class:`embryo` e: Embryo object for the sample
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:param str name: Sample name from :func:`sample_name`
+	:param dict entry: Manifest entry
+	:param str stage: ``thresh``, ``pca`` or ``align``
+	'''
+
+	ckdir = os.path.join(P.outdir,'checkpoints',name)
+	os.makedirs(ckdir,exist_ok=True)
+
+	if stage == 'thresh':
+		for ch in e.chnls.keys():
+			cranium.write_data_hdf5(os.path.join(ckdir,ch+'_thresh.hdf5'),e.chnls[ch].df_thresh,dtype=None,
+				columns=list(e.chnls[ch].df_thresh.columns))
+	elif stage == 'pca':
+		pickle.dump(e.chnls[P.c1_key].pcamed,open(os.path.join(ckdir,'pca.pkl'),'wb'))
+	elif stage == 'align':
+		for ch in e.chnls.keys():
+			cranium.write_data_hdf5(os.path.join(ckdir,ch+'_align.hdf5'),e.chnls[ch].df_align,dtype=None,
+				columns=list(e.chnls[ch].df_align.columns))
+		pickle.dump({ch:e.chnls[ch].mm for ch in e.chnls.keys()},open(os.path.join(ckdir,'mm.pkl'),'wb'))
+
+	entry['stage'] = stage
+	write_manifest_entry(P,name,entry)
+
+def load_stage(P,name,ch,stage):
+	'''
+	Read a dataframe saved by :func:`save_stage`
+
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:param str name: Sample name from :func:`sample_name`
+	:param str ch: Channel key
+	:param str stage: ``thresh`` or ``align``
+	:returns: pd.DataFrame with the original index
+	'''
+
+	df = cranium.read_data_hdf5(os.path.join(P.outdir,'checkpoints',name,ch+'_'+stage+'.hdf5'))
+	df = df.set_index('i')
+	df.index.name = None
+
+	return(df)
+
 def process(num,P=None):
 	'''
 	Run through the processing steps for a single sample through saving psi files
 
+	Each completed stage is saved with :func:`save_stage` so that a sample that fails or is interrupted resumes from the last saved stage when the output directory is reused. Samples recorded as complete in the manifest are skipped.
+
 	:param int num: Index of the file that is currently being processed
 	:param :class:`paramClass` P: Object containing all variables from config file
+	:returns: Tuple of the file index, success and processing time, which is None if the sample was skipped
 	'''
 
 	tic = time.time()
-	print(num,'Starting sample')
+	entry = None
 	try:
-		e = cranium.embryo(P.expname,num,P.outdir)
+		name = sample_name(num,P)
+		entry = load_manifest_entry(num,P)
+		stage = entry['stage']
 
-		#Add channels and preprocess data
-		e.add_channel(os.path.join(P.c1_dir,P.c1_files[num]),P.c1_key)
-		e.chnls[P.c1_key].preprocess_data(P.genthresh,P.scale,P.microns)
-		for i in range(len(P.Lcdir)):
-			e.add_channel(os.path.join(P.Lcdir[i],P.Lcfiles[i][num]),P.Lckey[i])
-			e.chnls[P.Lckey[i]].preprocess_data(P.genthresh,P.scale,P.microns)
+		if stage == 'complete':
+			print(num,'Already complete, skipping')
+			return(num,True,None)
+
+		print(num,'Starting sample from stage',stage)
+		e = cranium.embryo(P.expname,num,P.outdir)
+		files = input_files(num,P)
+		keys = [P.c1_key] + P.Lckey
+
+		#Add channels and threshold all channels in a single pass
+		if stage == None:
+			for ch in keys:
+				#Only the structural channel is needed in memory for PCA
+				e.add_channel(files[ch],ch,lazy=(ch != P.c1_key))
+			e.preprocess_channels(P.genthresh,P.scale,P.microns)
+			save_stage(e,P,name,entry,'thresh')
+		else:
+			for ch in keys:
+				e.chnls[ch] = cranium.brain()
+				if stage == 'thresh':
+					e.chnls[ch].df_thresh = load_stage(P,name,ch,'thresh')
 
 		#Calculate PCA transformation for structural channel, c1
-		if P.twoD == True:
-			e.chnls[P.c1_key].calculate_pca_median_2d(e.chnls[P.c1_key].raw_data,P.medthresh,P.radius,P.microns)
+		if stage in [None,'thresh']:
+			if stage == 'thresh':
+				e.chnls[P.c1_key].read_data(files[P.c1_key])
+			if P.twoD == True:
+				e.chnls[P.c1_key].calculate_pca_median_2d(e.chnls[P.c1_key].raw_data,P.medthresh,P.radius,P.microns,
+					workers=filter_threads(P),pyramid=P.pyramid)
+			else:
+				e.chnls[P.c1_key].calculate_pca_median(e.chnls[P.c1_key].raw_data,P.medthresh,P.radius,P.microns,
+					workers=filter_threads(P),pyramid=P.pyramid)
+			save_stage(e,P,name,entry,'pca')
+		elif stage == 'pca':
+			e.chnls[P.c1_key].pcamed = pickle.load(open(os.path.join(P.outdir,'checkpoints',name,'pca.pkl'),'rb'))
+			for ch in keys:
+				e.chnls[ch].df_thresh = load_stage(P,name,ch,'thresh')
+
+		#Align all channels using the structural channel PCA
+		if stage in [None,'thresh','pca']:
 			pca = e.chnls[P.c1_key].pcamed
-			e.chnls[P.c1_key].pca_transform_2d(e.chnls[P.c1_key].df_thresh,pca,P.comporder,P.fitdim,deg=P.deg)
-
-			#Transform additional channels
-			for i in range(len(P.Lcdir)):
-				e.chnls[P.Lckey[i]].pca_transform_2d(e.chnls[P.Lckey[i]].df_thresh,pca,P.comporder,P.fitdim,deg=P.deg)
-
+			for ch in keys:
+				if P.twoD == True:
+					e.chnls[ch].pca_transform_2d(e.chnls[ch].df_thresh,pca,P.comporder,P.fitdim,deg=P.deg)
+				else:
+					e.chnls[ch].pca_transform_3d(e.chnls[ch].df_thresh,pca,P.comporder,P.fitdim,deg=P.deg)
+			save_stage(e,P,name,entry,'align')
 		else:
-			e.chnls[P.c1_key].calculate_pca_median(e.chnls[P.c1_key].raw_data,P.medthresh,P.radius,P.microns)
-			pca = e.chnls[P.c1_key].pcamed
-			e.chnls[P.c1_key].pca_transform_3d(e.chnls[P.c1_key].df_thresh,pca,P.comporder,P.fitdim,deg=P.deg)
-
-			#Transform additional channels
-			for i in range(len(P.Lcdir)):
-				e.chnls[P.Lckey[i]].pca_transform_3d(e.chnls[P.Lckey[i]].df_thresh,pca,P.comporder,P.fitdim,deg=P.deg)
-
-		# print(num,'Starting coordinate transformation')
-		# e.chnls[P.c1_key].transform_coordinates()
-		# for i in range(len(P.Lcdir)):
-		# 	e.chnls[P.Lckey[i]].transform_coordinates()
-
-		#e.save_psi()
-		columns = ['x','y','z']
+			mm = pickle.load(open(os.path.join(P.outdir,'checkpoints',name,'mm.pkl'),'rb'))
+			for ch in keys:
+				e.chnls[ch].df_align = load_stage(P,name,ch,'align')
+				e.chnls[ch].mm = mm[ch]
+
+		if P.transform != None:
+			print(num,'Starting coordinate transformation')
+			for ch in e.chnls.keys():
+				e.chnls[ch].transform_coordinates(method=P.transform)
+			columns = ['x','y','z','ac','r','theta']
+		else:
+			columns = ['x','y','z']
 
 		for ch in e.chnls.keys():
 			cranium.write_data(os.path.join(e.outdir,
@@ -247,11 +474,135 @@ def process(num,P=None):
 				e.chnls[ch].df_align[columns])
 
 		toc = time.time()
+		entry['time'] += toc-tic
+		entry['error'] = None
+		entry['stage'] = 'complete'
+		write_manifest_entry(P,name,entry)
+		shutil.rmtree(os.path.join(P.outdir,'checkpoints',name),ignore_errors=True)
+
 		print(num,'Complete',toc-tic)
+		return(num,True,toc-tic)
 
 	except:
 		toc = time.time()
+
+		#The manifest entry can only be updated if it was read successfully
+		if entry != None:
+			entry['time'] += toc-tic
+			entry['error'] = str(exc_info()[1])
+			write_manifest_entry(P,name,entry)
+
 		print(num,'Failed',toc-tic,exc_info())
+		return(num,False,toc-tic)
+
+def filter_threads(P):
+	'''
+	Number of threads used by each sample for the median filter so that worker processes and their threads together do not exceed the number of cpus
+
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:returns: Integer
+	'''
+
+	if P.workers == None:
+		return(1)
+	else:
+		return(max(1,mp.cpu_count()//P.workers))
+
+def sample_size(num,P):
+	'''
+	Calculate the total size of the input files for a sample, which is used to estimate processing time
+
+	:param int num: Index of the file in each channel directory
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:returns: Size in bytes, or 0 if an input file cannot be found so that the error is recorded by :func:`process`
+	'''
+
+	try:
+		size = os.path.getsize(os.path.join(P.c1_dir,P.c1_files[num]))
+		for i in range(len(P.Lcdir)):
+			size += os.path.getsize(os.path.join(P.Lcdir[i],P.Lcfiles[i][num]))
+	except (OSError,IndexError):
+		size = 0
+
+	return(size)
+
+def virtual_memory():
+	'''
+	Virtual memory size of the current process
+
+	:returns: Size in bytes, or 0 where it cannot be read from /proc, e.g. on macOS
+	'''
+
+	try:
+		with open('/proc/self/statm') as f:
+			return(int(f.read().split()[0])*resource.getpagesize())
+	except (OSError,ValueError,AttributeError):
+		return(0)
+
+def limit_memory(maxmem):
+	'''
+	Limit the address space of a worker process so that a sample which exceeds the limit fails with a MemoryError instead of exhausting memory for all workers
+
+	The limit applies to virtual memory (RLIMIT_AS), not resident memory. It is set to `maxmem` plus the address space already reserved by the worker when it starts, which includes numpy and the buffers of its BLAS threads. Memory that is reserved later but never used, e.g. allocator arenas for the median filter threads, still counts toward the limit, so `maxmem` should be set well above the resident memory expected for a sample.
+
+	.. warning:: Only available on systems that provide the resource module, e.g. Linux and macOS
+
+	:param int maxmem: Additional virtual memory in MB or None
+	'''
+
+	if (maxmem != None) and (resource != None):
+		limit = int(maxmem*1024**2) + virtual_memory()
+		resource.setrlimit(resource.RLIMIT_AS,(limit,limit))
+
+def run(P,Lnums):
+	'''
+	Process samples in a single pool of worker processes
+
+	Samples are started in order of decreasing input file size so that the largest samples do not finish last. Progress and an estimate of the remaining time are printed as each sample finishes.
+
+	:param :class:`paramClass` P: Object containing all variables from config file
+	:param list Lnums: List of file indices to process
+	:returns: List of tuples containing the file index, success and time for each sample, with a time of None for skipped samples
+	'''
+
+	sizes = {num:sample_size(num,P) for num in Lnums}
+	Lnums = sorted(Lnums,key=lambda num: sizes[num],reverse=True)
+	total = sum(sizes.values())
+
+	workers = P.workers
+	if workers == None:
+		workers = mp.cpu_count()
+	print('Processing',len(Lnums),'samples with',workers,'workers')
+
+	processfxn = partial(process,P=P)
+
+	tic = time.time()
+	done = 0
+	Lresults = []
+	pool = mp.Pool(workers,initializer=limit_memory,initargs=(P.maxmem,))
+	for num,success,dt in pool.imap_unordered(processfxn,Lnums):
+		Lresults.append((num,success,dt))
+
+		#Skipped samples do not contribute to the processing rate
+		if dt == None:
+			total -= sizes[num]
+		else:
+			done += sizes[num]
+
+		#Estimate remaining time from the fraction of input data that has been processed
+		elapsed = time.time()-tic
+		eta = elapsed*(total-done)/max(done,1)
+		print('Progress:',len(Lresults),'of',len(Lnums),'samples,',
+			int(elapsed),'s elapsed, approximately',int(eta),'s remaining')
+	pool.close()
+	pool.join()
+
+	failed = [num for num,success,dt in Lresults if success == False]
+	print('Processing complete',time.time()-tic,'s, cpu time',sum([dt for num,success,dt in Lresults if dt != None]),'s')
+	if len(failed) > 0:
+		print('Failed samples:',failed)
+
+	return(Lresults)
 
 
 if __name__=='__main__':
@@ -259,24 +610,14 @@ if __name__=='__main__':
 	f,config_path = argv
 	P = paramsClass(config_path)
 
-	#Create out directory stamped with current date and time
-	outdir = os.path.join(P.rootdir,'Output'+time.strftime("%m-%d-%H-%M",time.localtime()))
-	os.mkdir(outdir)
+	#Create out directory stamped with current date and time or reuse the directory of a previous run
+	if P.resume != None:
+		outdir = P.resume
+	else:
+		outdir = os.path.join(P.rootdir,'Output'+time.strftime("%m-%d-%H-%M",time.localtime()))
+		os.mkdir(outdir)
 	P.add_outdir(outdir)
 	print('outdir',outdir)
 
-	processfxn = partial(process,P=P)
-
 	Lnums = check_nums(P)
-	n = len(Lnums)
-	# Initiate map pools in sets of 5 samples
-	for i in range(0,n,5):
-		if i+5>n:
-			L = Lnums[i:n]
-		else:
-			L = Lnums[i:i+5]
-
-		pool = mp.Pool()
-		pool.map(processfxn,L)
-		pool.close()
-		pool.join()
+	run(P,Lnums)
@@ -9,7 +9,7 @@ import numpy as np
 import pandas as pd
 import re
 
-def transform_file(f,model=None,test=False,tri=False):
+def transform_file(f,model=None,test=False,tri=False,method='vectorized'):
 
 	print(f, 'starting')
 
@@ -39,7 +39,7 @@ def transform_file(f,model=None,test=False,tri=False):
 			# return(s)
 
 		# if test==False:
-		s.transform_coordinates()
+		s.transform_coordinates(method=method)
 
 		cranium.write_data(f,s.df_align)
 
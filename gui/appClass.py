@@ -104,21 +104,23 @@ class Sample:
 			print(i,c.dir,c.key)
 			if c.dir != None:
 				print(i,'data processing')
-				e.add_channel(os.path.join(c.dir,self.fs[i]),c.key)
-				e.chnls[c.key].preprocess_data(pc['genthresh'],[1,1,1],pc['microns'])
+				#Reuse thresholded data and PCA from previous alignments of this file
+				fpath = os.path.join(c.dir,self.fs[i])
+				e.chnls[c.key] = cranium.brain()
+				e.chnls[c.key].preprocess_data_cached(fpath,pc['genthresh'],[1,1,1],pc['microns'])
 
 				#Processing for the structural channel
 				if i==0:
 					if D == 3:
 						print('comporder',pc['comporder'])
-						e.chnls[c.key].calculate_pca_median(e.chnls[c.key].raw_data,pc['medthresh'],
+						e.chnls[c.key].calculate_pca_median_cached(fpath,pc['medthresh'],
 							pc['radius'],pc['microns'])
 						pca = e.chnls[c.key].pcamed
 						e.chnls[c.key].pca_transform_3d(e.chnls[c.key].df_thresh,pca,
 							pc['comporder'],pc['fitdim'],deg=pc['deg'])
 					elif D == 2:
-						e.chnls[c.key].calculate_pca_median_2d(e.chnls[c.key].raw_data,pc['medthresh'],
-							pc['radius'],pc['microns'])
+						e.chnls[c.key].calculate_pca_median_cached(fpath,pc['medthresh'],
+							pc['radius'],pc['microns'],twoD=True)
 						pca = e.chnls[c.key].pcamed
 						e.chnls[c.key].pca_transform_2d(e.chnls[c.key].df_thresh,pca,
 							pc['comporder'],pc['fitdim'],deg=pc['deg'])
@@ -192,7 +194,7 @@ class Sample:
 		fig, axarr = plt.subplots(n,3,num='Sample '+self.key) #(rows, columns)
 
 		for i,df in enumerate(Ldf):
-			df = df.sample(frac=0.01)
+			df = cranium.voxel_sample(df,20000)
 			axarr[i,0].scatter(df.x,df.z)
 			axarr[i,1].scatter(df.x,df.y)
 			axarr[i,2].scatter(df.z,df.y)